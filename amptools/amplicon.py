@@ -4,7 +4,7 @@ import itertools
 import csv
 import cigar
 import json
-from fastinterval import Interval
+from bisect import bisect_left, bisect_right
 import logging; log = logging.getLogger(__name__)
 # set the pileup engine to allow 1500 samples at depth of 200
 PILEUP_MAX_DEPTH = 200 * 1500
@@ -12,6 +12,9 @@ PILEUP_MAX_DEPTH = 200 * 1500
 
 
 def load_amplicons(design, stats, opts):
+    # fastinterval imports numpy through pyfasta, so import it here to keep
+    # amptools start up fast
+    from fastinterval import Interval
     amplicons = []
     for row in csv.DictReader(file(design, 'U'), delimiter=opts.delimiter):
         amp_loc = Interval.from_string(row[opts.amplicon_column])
@@ -36,6 +39,7 @@ def load_amplicons(design, stats, opts):
 
 
 def load_amplicons_from_header(header, stats, samfile, clip=True, load_pileups=True):
+    from fastinterval import Interval
     amplicons = []
     for row in header['CO']:
         try:
@@ -112,47 +116,19 @@ class Amplicon(object):
         return match
 
 
-    def _find_position(self, pos, posns, lower=True):
-
-        # find the pairing to a given position in the reference
-        for x in enumerate(posns):
-            if x[1] == pos:
-                match = x
-                break
-        else:
-            return None
-
-        # if this is aligned to a read base, return that
-        if match[0] is not None:
-            return match[0]
-
-        # otherwise, walk the alignment to find the next base
-        index = posns.index(match)
-        while match[0] is None:
-
-            if lower:
-                index += 1
-                if index >= len(posns):
-                    return None
-            else:
-                index -=1
-                if index < 0:
-                    return None
-
-            match = posns[index]
-        return match[0]
-
-
     def clip(self, read):
         """ clip a read to the trim locations of this amplicon """
 
+        # exclude primer only reads, which have no base aligned to either
+        # trim location
+        start, end = read.pos, read.aend
+        if not (start <= self.trim_start < end or start <= self.trim_end < end):
+            return None
+
         # calculate where to clip
-        posns = read.positions
-        first_base_pos = self._find_position(self.trim_start, posns)
-        last_base_pos = self._find_position(self.trim_end, posns, lower=False)
+        first_base_pos, last_base_pos = cigar.aligned_indexes(
+            read.cigar, start, (self.trim_start, self.trim_end))
 
-        # exlude primer only reads
-        # TODO: may be better to check the read start end for this
         if not (first_base_pos or last_base_pos):
             return None
 
@@ -190,3 +166,45 @@ class Amplicon(object):
         read.tags = (read.tags or []) + [('EA', self.external_id)]
         return read
 
+
+class AmpliconIndex(object):
+    """ Sorted start/end index over the amplicons of one reference.
+
+        Forward reads can only match an amplicon on its start and reverse
+        reads on its end, so a read is only tested against the amplicons
+        whose start (or end) lies within offset_allowed of read.pos (or
+        read.aend).  Candidates are returned in the original amplicon order
+        so the first matching amplicon is the same as a linear scan.
+    """
+
+    def __init__(self, amplicons):
+        self.amplicons = list(amplicons)
+        self.window = max([a.offset_allowed for a in self.amplicons] or [0])
+
+        starts = sorted((a.start, i) for (i, a) in enumerate(self.amplicons))
+        ends = sorted((a.end, i) for (i, a) in enumerate(self.amplicons))
+        self._starts = [x[0] for x in starts]
+        self._start_ids = [x[1] for x in starts]
+        self._ends = [x[0] for x in ends]
+        self._end_ids = [x[1] for x in ends]
+
+    def __len__(self):
+        return len(self.amplicons)
+
+    def candidates(self, read):
+        """ return the amplicons that could match read, in input order """
+        if read.is_unmapped or not self.amplicons:
+            return []
+
+        if read.is_reverse:
+            keys, ids, pos = self._ends, self._end_ids, read.aend
+        else:
+            keys, ids, pos = self._starts, self._start_ids, read.pos
+
+        # matches() requires abs(pos - x) < offset_allowed
+        lo = bisect_left(keys, pos - self.window + 1)
+        hi = bisect_right(keys, pos + self.window - 1)
+        if hi - lo == 1:
+            return [self.amplicons[ids[lo]]]
+        return [self.amplicons[i] for i in sorted(ids[lo:hi])]
+
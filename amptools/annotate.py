@@ -1,15 +1,19 @@
+import os
 import sys
 import itertools
 import logging; log = logging.getLogger(__name__)
 
 import json
-from collections import Counter
-
-import pysam
-import ngram
+from collections import Counter, OrderedDict, deque
 
 import amplicon
+import bamio
+import barcode
+import clip
+import metrics
+import parallel
 import stats
+import trimindex
 
 TAG_COUNT = 'mc'
 TAG_AMP = 'ea'
@@ -37,14 +41,154 @@ def _read_trim_file(trim_file):
     return read_mids
 
 
-class MidAnnotator(object):
+class StreamingTrimFile(object):
+    """ Look up barcodes or molecular counters by walking a trim file.
+
+        When the BAM is in the same order as the trim file each lookup is
+        answered by the next line, so memory stays constant.  Lines passed
+        over while searching for an accession are kept in a lookahead buffer
+        of at most `lookahead` entries, so reads that fall out of order are
+        still found if they are within the buffer.  When the buffer is full,
+        the oldest lines before the last line found by reading ahead are
+        dropped to make room, so a BAM holding only some of the reads of the
+        file, in the same order, is still streamed.  The accessions of
+        dropped lines are kept, and looking one up raises an exception.
+        Lines read ahead for a lookup that is not found are not dropped, and
+        if that read turns up later in the file an exception is raised too:
+        either way the BAM was further out of order than the lookahead, and
+        stopping is better than annotating reads wrongly.  The last
+        `lookahead` lines used are also kept, so mates and other records of
+        the same read are found again.
+    """
+
+    def __init__(self, trim_file, lookahead=100000):
+        log.info('streaming file {0}'.format(trim_file))
+        self.trim_file = trim_file
+        self.lookahead = lookahead
+        self._lines = file(trim_file)
+        self._line = 0
+        # accession -> (line number, mid)
+        self._buffer = OrderedDict()
+        # line number of the last line found by reading ahead
+        self._found = -1
+        self._used = OrderedDict()
+        self._missed = set()
+        self._dropped = set()
+        self.out_of_order = 0
+        self.repeated = 0
+
+    def _too_far(self, accession):
+        return Exception('{0} was not found in {1} within --trim-lookahead {2} lines, '
+            'the BAM is too far out of order to stream this file'.format(
+                accession, self.trim_file, self.lookahead))
+
+    def _read_line(self):
+        line = self._lines.next()
+        try:
+            mid, accession = line.rstrip().split(' ', 1)
+        except ValueError, e:
+            raise Exception('could not parse file %s: %s' % (self.trim_file, e))
+        if accession in self._missed:
+            raise self._too_far(accession)
+        self._line += 1
+        return accession, mid
+
+    def _use(self, qname, mid):
+        used = self._used
+        used[qname] = mid
+        if len(used) > self.lookahead:
+            used.popitem(last=False)
+        return mid
+
+    def _make_room(self):
+        """ drop the oldest buffered line if it was passed over """
+        buf = self._buffer
+        if len(buf) < self.lookahead:
+            return True
+        accession, (line, mid) = next(buf.iteritems())
+        if line >= self._found:
+            return False
+        del buf[accession]
+        self._dropped.add(accession)
+        return True
+
+    def __getitem__(self, qname):
+        buf = self._buffer
+        if buf:
+            try:
+                line, mid = buf.pop(qname)
+            except KeyError:
+                pass
+            else:
+                if not self.out_of_order:
+                    log.info('{0} is not in BAM order, using lookahead buffer'.format(self.trim_file))
+                self.out_of_order += 1
+                return self._use(qname, mid)
+
+        if qname in self._used:
+            self.repeated += 1
+            return self._used[qname]
+        if qname in self._dropped:
+            raise self._too_far(qname)
+
+        # read ahead until we find the read or the buffer is full
+        while self._make_room():
+            try:
+                accession, mid = self._read_line()
+            except StopIteration:
+                break
+            if accession == qname:
+                self._found = self._line
+                return self._use(qname, mid)
+            buf[accession] = (self._line, mid)
+        self._missed.add(qname)
+        raise KeyError(qname)
+
+    def report(self):
+        print 'streamed {0}: {1} out of order, {2} repeated, {3} passed over, {4} not found'.format(
+            self.trim_file, self.out_of_order, self.repeated, len(self._dropped), len(self._missed))
+
+
+def _open_trim_file(trim_file, args):
+    """ open a trim file for lookup by read accession
+
+        Streams or memory maps the file if requested, otherwise loads it.
+    """
+    if getattr(args, 'stream_trim', False):
+        return StreamingTrimFile(trim_file, args.trim_lookahead)
+    if getattr(args, 'trim_index', False):
+        return trimindex.open_index(trim_file)
+    return _read_trim_file(trim_file)
+
+
+class Annotator(object):
+    """ Base class for annotators.
+
+        Subclasses implement annotate(read, tags), appending any new tags to
+        the tags list instead of setting them on the read, so the annotate
+        pipeline can write the tags from every annotator in one assignment.
+        annotate returns False to exclude the read.
+    """
+
+    def annotate(self, read, tags):
+        raise NotImplementedError
+
+    def __call__(self, read):
+        """ annotate a single read, setting its tags """
+        tags = []
+        result = self.annotate(read, tags)
+        if tags:
+            read.tags = read.tags + tags
+        return result
+
+
+class MidAnnotator(Annotator):
     """ Annotate BAM file with read groups (RGs) based on molecular barcodes.
 
         This annotator adds RGs to the header and assigns each read a RG tag with the
         reag group and a BC tag with the barcode read.
     """
 
-    # TODO: if the BAM is in the same order as the reads, can we avoid preloading read mids
     # TODO: write the barcode quality attribute
 
     @classmethod
@@ -56,8 +200,15 @@ class MidAnnotator(object):
         group.add_argument('--library', type=str, help='(optional) library to use in RG header')
         group.add_argument('--platform', type=str, help='(optional) platform to use in RG header')
         group.add_argument('--exclude-rg', type=str, help='(optional) platform to use in RG header')
-        group.add_argument('--offbyone', action='store_true', help='Allow off by one errors in the MID')
-        group.add_argument('--ngram', action='store_true', help='Match MIDs using ngrams')
+        group.add_argument('--bc-distance', type=int, default=0,
+                help='Match MIDs within this distance of a single barcode (default 0, exact)')
+        group.add_argument('--bc-metric', choices=barcode.METRICS, default=barcode.HAMMING,
+                help='Distance used by --bc-distance (default hamming)')
+        group.add_argument('--bc-cache', type=int, default=100000,
+                help='Number of inexact MID matches to remember (default 100000)')
+        group.add_argument('--offbyone', action='store_true', help='Allow off by one errors in the MID (--bc-distance 1)')
+        group.add_argument('--ngram', action='store_true',
+                help='Allow an insertion, deletion or substitution in the MID (--bc-distance 1 --bc-metric edit)')
 
 
     def __init__(self, args, header):
@@ -70,10 +221,10 @@ class MidAnnotator(object):
 
         # parse the trim file of actually read mids
         if args.bcs_read:
-            self.read_bcs = _read_trim_file(args.bcs_read)
+            self.read_bcs = _open_trim_file(args.bcs_read, args)
             self.read_rgs = None
         else:
-            self.read_rgs = _read_trim_file(args.rgs_read)
+            self.read_rgs = _open_trim_file(args.rgs_read, args)
             self.read_bcs = None
 
 
@@ -105,35 +256,40 @@ class MidAnnotator(object):
 
         header['RG'] = RGS
 
-        # precompute off by one errors:
+        # index barcodes for reads that do not match exactly
+        distance = getattr(args, 'bc_distance', 0)
+        metric = getattr(args, 'bc_metric', barcode.HAMMING)
         if args.offbyone:
-            for bc, mid in self.mids.items():
-                for (i, base) in enumerate(bc):
-                    for sub in 'ACGT':
-                        if sub != base:
-                            alt = bc[:i] + sub + bc[i+1:]
-                            if alt not in self.mids:
-                                self.mids[alt] = mid
+            distance = max(distance, 1)
         if args.ngram:
-            self.ngram = ngram.NGram(self.mids.keys(), threshold=0.5)
+            distance, metric = max(distance, 1), barcode.EDIT
+        if distance:
+            self.index = barcode.BarcodeIndex(self.mids.keys(), distance, metric)
         else:
-            self.ngram = None
+            self.index = None
+
+        # remember inexact matches, including reads with no match
+        self.cache = barcode.LRUCache(getattr(args, 'bc_cache', 100000))
 
     def match_read(self, read_mid):
         try:
             return self.mids[read_mid]
         except KeyError:
-            if self.ngram:
-                matches = self.ngram.search(read_mid)
-                #log.info('match for {0} is {1}'.format(read_mid, matches[:3]))
-                if matches:
-                    match = matches[0][0]
-                    return self.mids[match]
-            raise
+            if not self.index:
+                raise
 
-    def __call__(self, read):
         try:
-            if self.read_bcs:
+            match = self.cache[read_mid]
+        except KeyError:
+            match = self.cache[read_mid] = self.index.search(read_mid)
+
+        if match is None:
+            raise KeyError(read_mid)
+        return self.mids[match]
+
+    def annotate(self, read, tags):
+        try:
+            if self.read_bcs is not None:
                 read_bc = self.read_bcs[read.qname]
                 RG = self.match_read(read_bc)
                 etags = [('RG', RG), ('BC', read_bc)]
@@ -147,28 +303,44 @@ class MidAnnotator(object):
             return False
 
         self.counts[RG] += 1
-        read.tags = read.tags + etags
+        tags.extend(etags)
         if RG == self.exclude:
             return False
         return read
 
+    def reset(self):
+        self.counts.clear()
+        self.cache.hits = self.cache.misses = 0
+
+    def counters(self):
+        return self.counts, self.cache.hits, self.cache.misses
+
+    def merge(self, counters):
+        counts, hits, misses = counters
+        self.counts.update(counts)
+        self.cache.hits += hits
+        self.cache.misses += misses
+
     def report(self):
         print 'sample reads'
 
         for k,v in sorted(self.counts.items()):
            print k, v
-        pass
+        if self.index:
+            print 'inexact MID cache: {0} hits, {1} misses, {2} of {3} entries used'.format(
+                self.cache.hits, self.cache.misses, len(self.cache), self.cache.size)
+        for trim in (self.read_bcs, self.read_rgs):
+            if isinstance(trim, StreamingTrimFile):
+                trim.report()
 
 
-class DbrAnnotator(object):
+class DbrAnnotator(Annotator):
     """ Annotate BAM file with molecular counters (MCs).
 
         This annotator adds a MC tag for each read contaning any molecular
         counter sequence read.
     """
 
-    # TODO: same as MidAnnotator
-
     @classmethod
     def customize_parser(cls, parser):
         group = parser.add_argument_group('MC annotation', cls.__doc__)
@@ -177,29 +349,39 @@ class DbrAnnotator(object):
 
     def __init__(self, args, header):
         self.counts = Counter()
-        self.read_mids = _read_trim_file(args.counters)
+        self.read_mids = _open_trim_file(args.counters, args)
 
-    def __call__(self, read):
+    def annotate(self, read, tags):
         try:
             MC = self.read_mids[read.qname]
             if MC != '':
-                read.tags = read.tags + [(TAG_COUNT, MC)]
+                tags.append((TAG_COUNT, MC))
             self.counts[MC] += 1
             return read
         except KeyError:
             self.counts[None] += 1
             # TODO: stats for missing counter
 
+    def reset(self):
+        self.counts.clear()
+
+    def counters(self):
+        return self.counts
+
+    def merge(self, counts):
+        self.counts.update(counts)
+
     def report(self):
         print 'counter reads'
 
         for k,v in sorted(self.counts.items()):
            print k, v
-        pass
+        if isinstance(self.read_mids, StreamingTrimFile):
+            self.read_mids.report()
 
 
 
-class AmpliconAnnotator(object):
+class AmpliconAnnotator(Annotator):
     """ Annotate reads that match expected amplicons (EAs).
 
         Mark each read that matches and expected amplicon with an EA tag and
@@ -248,18 +430,26 @@ class AmpliconAnnotator(object):
         header['CO'] = header.get('CO', []) + AMS
 
         # create a list of lists ref by tid
-        self._amps_by_chr = []
+        amps_by_chr = []
         for _ in range(args.input.nreferences):
-            self._amps_by_chr.append([])
+            amps_by_chr.append([])
 
         for a in self.amplicons:
-            self._amps_by_chr[args.input.gettid(a.chr)].append(a)
+            amps_by_chr[args.input.gettid(a.chr)].append(a)
 
-    def __call__(self, read):
-        for amp in self._amps_by_chr[read.tid]:
+        # index each reference by amplicon start and end
+        self._amps_by_chr = [amplicon.AmpliconIndex(x) for x in amps_by_chr]
+
+    def annotate(self, read, tags):
+        if read.tid < 0:
+            candidates = []
+        else:
+            candidates = self._amps_by_chr[read.tid].candidates(read)
+
+        for amp in candidates:
             if amp.matches(read):
                 # FIXME: amplicon mark method
-                read.tags = read.tags + [(TAG_AMP, amp.external_id)]
+                tags.append((TAG_AMP, amp.external_id))
                 if self.clip:
                     clipped = amp.clip(read)
                     if clipped:
@@ -275,19 +465,115 @@ class AmpliconAnnotator(object):
         return read
 
 
+    def reset(self):
+        self.stats.reset()
+
+    def counters(self):
+        return self.stats
+
+    def merge(self, stats):
+        self.stats.merge(stats)
+
     def report(self):
         self.stats.report(sys.stdout)
 
 
-def annotate(args):
-    """ Annotate reads in a SAM file with tags.
+def _annotate_read(annotators, read, tags):
+    """ run the annotators on read, returning False when one excludes it """
+    for annotator in annotators:
+        # Annotators return False to exclude
+        if annotator.annotate(read, tags) is False:
+            metrics.count('excluded by ' + type(annotator).__name__)
+            return False
+    return True
 
-        Use one or more available annotators below to add tags to a SAM file.
 
+def _annotate_reads(annotators, reads, write):
+    """ run the annotators over reads, passing included reads to write.  The
+        annotators only go through _annotate_read, to be timed and count
+        exclusions, when metrics are on.
     """
-    inp = args.input = pysam.Samfile(args.input)
+    timed = metrics.enabled()
+    annotate_read = metrics.timer('annotate', _annotate_read)
+    processed = 0
+    included = 0
+    for read in reads:
+        processed += 1
+        tags = []
+        if timed:
+            include = annotate_read(annotators, read, tags)
+        else:
+            include = True
+            for annotator in annotators:
+                # Annotators return False to exclude
+                if annotator.annotate(read, tags) is False:
+                    include = False
+                    break
+        if include:
+            # write the tags from every annotator at once
+            if tags:
+                read.tags = read.tags + tags
+            included += 1
+            write(read)
+    return processed, included
 
-    header = inp.header
+
+# annotators and input shared with forked shard workers
+_shard_state = {}
+
+def _annotate_shard(job):
+    """ annotate one shard of the input into its own BAM """
+    i, start, end, shard_path = job
+    annotators = _shard_state['annotators']
+    for a in annotators:
+        a.reset()
+
+    inp = bamio.open_bam(_shard_state['path'])
+    oup = bamio.open_output(shard_path, _shard_state['args'], header=_shard_state['header'])
+    processed, included = _annotate_reads(annotators, parallel.iter_shard(inp, start, end),
+        metrics.timer('write', oup.write))
+    oup.close()
+    inp.close()
+
+    return shard_path, processed, included, [a.counters() for a in annotators]
+
+
+def _annotate_sharded(path, inp, header, annotators, args):
+    """ annotate shards of the input in worker processes
+
+        Shard outputs are merged in input order and the annotator counts
+        from each shard are added to the annotators of this process.
+    """
+    if path == '-' or not os.path.isfile(path):
+        raise Exception('--workers needs a BAM file, not a stream')
+    if any(isinstance(getattr(a, x, None), StreamingTrimFile)
+            for a in annotators for x in ('read_bcs', 'read_rgs', 'read_mids')):
+        raise Exception('--stream-trim cannot be used with --workers')
+
+    shards = parallel.plan_shards(inp, path, args.workers * 4)
+    _shard_state.update(annotators=annotators, path=path, header=header, args=args)
+
+    processed = included = 0
+    oup = parallel.OrderedMerge(args.output, header, args)
+    try:
+        pool = parallel.ShardPool(args.workers)
+        for (shard_path, p, n, counts) in pool.imap(_annotate_shard, shards):
+            processed += p
+            included += n
+            metrics.advance(p)
+            for (a, c) in zip(annotators, counts):
+                a.merge(c)
+            oup.append(shard_path)
+            os.unlink(shard_path)
+    finally:
+        _shard_state.clear()
+    oup.close()
+
+    return processed, included
+
+
+def _load_annotators(args, header):
+    """ create the annotators enabled by args, updating header """
     annotators = []
 
     try:
@@ -302,24 +588,31 @@ def annotate(args):
         raise
         sys.exit(1)
 
+    return annotators
+
+
+def annotate(args):
+    """ Annotate reads in a SAM file with tags.
+
+        Use one or more available annotators below to add tags to a SAM file.
+
+    """
+    path = args.input
+    inp = args.input = bamio.open_bam(args.input, args=args)
+
+    header = inp.header
+    annotators = _load_annotators(args, header)
+
     assert 'SQ' in header # http://code.google.com/p/pysam/issues/detail?id=84
-    oup = pysam.Samfile(args.output, 'wb', header=header)
 
     log.info('begin read annotation')
-    processed = 0
-    included = 0
-    for read in inp:
-        processed += 1
-        include = True
-        for annotator in annotators:
-            # Annotators return False to exclude
-            if annotator(read) is False:
-                include = False
-                break
-        if include:
-            included += 1
-            oup.write(read)
-
+    if args.workers > 1:
+        processed, included = _annotate_sharded(path, inp, header, annotators, args)
+    else:
+        oup = bamio.open_output(args.output, args, header=header)
+        processed, included = _annotate_reads(annotators, metrics.read_input(inp, path),
+            metrics.timer('write', oup.write))
+        oup.close()
 
     for a in annotators:
         a.report()
@@ -327,30 +620,69 @@ def annotate(args):
     print 'processed {0} reads, kept {1} ({2} %)'.format(processed, included, 100*float(included)/processed)
 
 
-def duplicates(args):
-    """ Mark duplicates using a molecular counter.
+def _report_duplicates(counts, stream):
+    print >>stream, 'duplicates: {0} reads, {1} unique, {2} duplicates, {3} missing RG or MC'.format(
+        counts['reads'], counts['unique'], counts['duplicates'], counts['missing tags'])
 
-        The file should contain MC tags.  Duplicates are detected by looking
-        for reads in the same start position and orientation and with the same MC tag.
 
-        WARNING: this unsorts your input
+def _chain_positions(positions, merge_distance):
+    """ split sorted start positions into runs where neighbours are within merge_distance """
+    current = []
+    for pos in positions:
+        if current and abs(pos - current[-1]) > merge_distance:
+            yield current
+            current = []
+        current.append(pos)
+    if current:
+        yield current
+
+
+class DuplicateMarker(object):
+    """ Mark duplicates using a molecular counter.
+
+        Reads are grouped by reference, orientation and start position,
+        merging starts within merge_distance, and then by RG and MC tag.  The
+        read with the best mapping quality in each group is kept and the rest
+        are marked as duplicates.  Reads without RG or MC tags are dropped.
     """
-    inp = pysam.Samfile(args.input, "rb" )
-    outp = pysam.Samfile(args.output, "wb", template=inp)
 
-    # TODO: check sorted
-    # TODO: report duplicates/unannotated stats
-    # TODO: add sort option when output set
+    merge_distance = 4
+
+    def __init__(self, umi_method=barcode.EXACT, umi_distance=1):
+        self.to_check = {}
+        self.counts = Counter()
+        self.umi_method = umi_method
+        self.umi_distance = umi_distance
+
+    @staticmethod
+    def customize_parser(parser):
+        parser.add_argument('--umi-method', choices=barcode.CLUSTER_METHODS, default=barcode.EXACT,
+                help='how to group molecular counters with sequencing errors (default exact)')
+        parser.add_argument('--umi-distance', type=int, default=1,
+                help='mismatches allowed between grouped molecular counters (default 1)')
+
+    def add(self, entry):
+        """ add a read, returning the reads that are ready to write """
+        # find out the start and orientation of the read
+        is_reverse = entry.is_reverse
+        start = entry.pos if not is_reverse else entry.aend
 
-    current_pos = None
-    to_check = {}
+        # append to the to_check index
+        position_index = (entry.rname, is_reverse, start)
+        self.to_check.setdefault(position_index, []).append(entry)
+        self.counts['reads'] += 1
+        return []
 
-    def filter_dups(group, positions):
-        """ filter a set of start positions for the best read by mapping quality """
+    def _pop_entries(self, group, current):
+        """ remove and return the reads at the start positions in current """
         entries = []
         for pos in current:
             log.debug('using entries from %s, %s' % (group, pos))
-            entries.extend(to_check.pop((group[0], group[1], pos)))
+            entries.extend(self.to_check.pop((group[0], group[1], pos)))
+        return entries
+
+    def _filter_dups(self, entries):
+        """ filter a set of reads for the best read by mapping quality """
 
         # hash based on the RG and the DBR
         log.debug('filter %s reads' % len(entries))
@@ -363,10 +695,13 @@ def duplicates(args):
                 #    continue
 
                 group = (rg, dbr)
-                groups[group] = groups.get(group, []) + [e]
+                groups.setdefault(group, []).append(e)
             except KeyError:
                 log.debug('read %s missing required tags' % e.qname)
+                self.counts['missing tags'] += 1
 
+        if self.umi_method != barcode.EXACT:
+            groups = self._cluster_counters(groups)
 
         # return the best read in each group
         for dups in groups.values():
@@ -379,66 +714,297 @@ def duplicates(args):
             ordered = sorted(dups, key=keyfunc)
             for not_best in ordered[:-1]:
                 not_best.is_duplicate = True
+                self.counts['duplicates'] += 1
                 yield not_best
             # mark duplicates
 
+            self.counts['unique'] += 1
             yield ordered[-1]
 
+    def _cluster_counters(self, groups):
+        """ merge the (RG, MC) groups whose counters differ by errors """
+        by_rg = {}
+        for (rg, dbr), reads in groups.items():
+            by_rg.setdefault(rg, {})[dbr] = len(reads)
+
+        merged = {}
+        for rg, counts in by_rg.items():
+            representative = barcode.cluster(counts, self.umi_distance, self.umi_method)
+            for dbr in counts:
+                merged.setdefault((rg, representative[dbr]), []).extend(groups[(rg, dbr)])
+        return merged
+
+    def finish(self):
+        """ group the reads added so far, yielding them with duplicates marked """
+        indexes = sorted(self.to_check.keys())
+        log.debug(indexes)
+        for group, inds in itertools.groupby(indexes, key=lambda x: x[:2]):
+
+            log.debug('processing group %(group)s' % locals())
+            for current in _chain_positions([x[2] for x in inds], self.merge_distance):
+                log.debug('deduping %(current)s' % locals())
+                for nondup in self._filter_dups(self._pop_entries(group, current)):
+                    yield nondup
+
+    def report(self, stream):
+        _report_duplicates(self.counts, stream)
+
+
+class SortedDuplicateMarker(DuplicateMarker):
+    """ Mark duplicates in coordinate sorted input as it is read.
+
+        A group of start positions is complete once the reads have moved more
+        than merge_distance past its last start, since no later read can start
+        before its own position.  Complete groups are marked straight away and
+        reads are released in input order, so only the reads around the
+        current position are held and the output stays sorted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SortedDuplicateMarker, self).__init__(*args, **kwargs)
+        self.pending = deque()
+        self.done = set()
+        self.kept = set()
+        self.last = None
+
+    def add(self, entry):
+        here = (entry.rname, entry.pos)
+        if self.last is not None and here != self.last:
+            # unmapped reads without a position come last in sorted files
+            if entry.rname >= 0 and (self.last[0] < 0 or here < self.last):
+                raise Exception('input is not coordinate sorted at read %s' % entry.qname)
+            if here[0] != self.last[0]:
+                self._flush()
+            else:
+                self._flush(entry.pos - self.merge_distance)
+        self.last = here
+
+        super(SortedDuplicateMarker, self).add(entry)
+        self.pending.append(entry)
+        return self._release()
+
+    def _flush(self, before=None):
+        """ mark the groups of positions that all end before the given start """
+        indexes = sorted(self.to_check.keys())
+        for group, inds in itertools.groupby(indexes, key=lambda x: x[:2]):
+            for current in _chain_positions([x[2] for x in inds], self.merge_distance):
+                if before is not None and current[-1] >= before:
+                    continue
+                entries = self._pop_entries(group, current)
+                self.kept.update(id(e) for e in self._filter_dups(entries))
+                self.done.update(id(e) for e in entries)
+
+    def _release(self):
+        """ return the marked reads at the head of the input order """
+        ready = []
+        pending, done, kept = self.pending, self.done, self.kept
+        while pending and id(pending[0]) in done:
+            entry = pending.popleft()
+            done.remove(id(entry))
+            if id(entry) in kept:
+                kept.remove(id(entry))
+                ready.append(entry)
+        return ready
+
+    def finish(self):
+        self._flush()
+        return self._release()
+
+
+def _duplicate_marker(args):
+    umi = (getattr(args, 'umi_method', barcode.EXACT), getattr(args, 'umi_distance', 1))
+    if getattr(args, 'sorted', False):
+        return SortedDuplicateMarker(*umi)
+    return DuplicateMarker(*umi)
+
+
+_reference_state = {}
+
+def _duplicates_reference(job):
+    """ mark the duplicates on one reference, or the unplaced reads, into their own BAM """
+    i, reference, shard_path = job
+    args = _reference_state['args']
+    marker = _duplicate_marker(args)
+
+    inp = bamio.open_bam(args.input)
+    if reference is None:
+        reads = parallel.iter_unplaced(inp, _reference_state['unplaced'])
+    else:
+        reads = inp.fetch(reference)
+    oup = bamio.open_output(shard_path, args, template=inp)
+    add = metrics.timer('dedup', marker.add)
+    write = metrics.timer('write', oup.write)
+    for entry in reads:
+        for nondup in add(entry):
+            write(nondup)
+    for nondup in metrics.iterate('dedup', marker.finish()):
+        write(nondup)
+    oup.close()
+    inp.close()
+
+    return shard_path, marker.counts
+
+
+def _duplicates_by_reference(args):
+    """ mark duplicates of each reference in worker processes
+
+        Duplicate groups never span references, so each reference of an
+        indexed BAM is marked on its own and the outputs are joined in header
+        order, followed by the reads without a reference.
+    """
+    if args.input == '-' or not parallel.index_file(args.input):
+        raise Exception('--workers needs an indexed BAM file')
+
+    inp = bamio.open_bam(args.input, 'rb', args)
+    header = inp.header
+    jobs = [(reference,) for reference in inp.references] + [(None,)]
+    _reference_state.update(args=args, unplaced=parallel.unplaced_offset(inp, args.input))
+    inp.close()
+
+    counts = Counter()
+    oup = parallel.OrderedMerge(args.output, header, args)
+    try:
+        pool = parallel.ShardPool(args.workers)
+        for (shard_path, c) in pool.imap(_duplicates_reference, jobs):
+            counts.update(c)
+            metrics.advance(c['reads'])
+            oup.append(shard_path)
+            os.unlink(shard_path)
+    finally:
+        _reference_state.clear()
+    oup.close()
+
+    _report_duplicates(counts, sys.stderr)
+
+
+def duplicates(args):
+    """ Mark duplicates using a molecular counter.
+
+        The file should contain MC tags.  Duplicates are detected by looking
+        for reads in the same start position and orientation and with the same MC tag.
+
+        WARNING: this unsorts your input, unless it is coordinate sorted and
+        --sorted is given.  Then duplicates are marked as the file is read,
+        holding only the reads near the current position, and the output
+        stays sorted.  With --two-pass the input is read twice, first to
+        decide the duplicates from a compact table and then to write the
+        reads in their original order, which needs far less memory for
+        unsorted input.  Indexed BAM files can be marked one reference per
+        process with --workers.
+    """
+    if getattr(args, 'two_pass', False):
+        if getattr(args, 'workers', 1) > 1:
+            raise Exception('--two-pass cannot be used with --workers')
+        return _duplicates_two_pass(args)
+    if getattr(args, 'workers', 1) > 1:
+        return _duplicates_by_reference(args)
 
-    n=0
-    for (i, entry) in enumerate(inp):
-        if (i % 10) == 0:
-            log.info('processed %(i)s reads' % locals())
+    inp = bamio.open_bam(args.input, 'rb', args)
+    outp = bamio.open_output(args.output, args, template=inp)
 
+    # TODO: add sort option when output set
+
+    marker = _duplicate_marker(args)
+    if not getattr(args, 'sorted', False) and inp.header.get('HD', {}).get('SO') == 'coordinate':
+        log.info('input is coordinate sorted, use --sorted to keep it sorted')
+
+    add = metrics.timer('dedup', marker.add)
+    write = metrics.timer('write', outp.write)
+    for entry in metrics.read_input(inp, args.input):
         # TODO: downsample?
         #if args.random and random.random() > args.random:
         #    continue
 
-        # find out the start and orientation of the read
-        is_reverse = entry.is_reverse
-        start = entry.pos if not is_reverse else entry.aend
+        for nondup in add(entry):
+            write(nondup)
 
-        # append to the to_check index
-        position_index = (entry.rname, is_reverse, start)
-        to_check[position_index] = to_check.get(position_index, []) + [entry]
+    for nondup in metrics.iterate('dedup', marker.finish()):
+        write(nondup)
+    outp.close()
 
-        if entry.pos != current_pos:
-            current_pos = entry.pos
+    marker.report(sys.stderr)
 
-            # TODO: could process some of the reads when the reference changes
-            # if entry.rname != rname: PASS
 
-    merge_distance = 4
-    indexes = sorted(to_check.keys())
-    log.debug(indexes)
-    for group, inds in itertools.groupby(indexes, key=lambda x: x[:2]):
-
-        log.debug('processing group %(group)s' % locals())
-        positions = [x[2] for x in inds]
-        current = [positions.pop(0)]
-
-        while True:
-            head = current[-1]
-            if len(positions):
-                consider = positions[0]
-                log.debug('head is %(head)s, considering %(consider)s' % locals())
-                if abs(consider - head) <= merge_distance:
-                    current.append(positions.pop(0))
-                    continue
+def _duplicates_two_pass(args):
+    """ mark duplicates from a table built on a first pass over args.input """
+    import duptable
+    if args.input == '-':
+        raise Exception('--two-pass needs an input file, not a stream')
 
-            log.debug('deduping %(current)s' % locals())
-            for nondup in filter_dups(group, positions):
-                outp.write(nondup)
-            if len(positions):
+    table = duptable.DuplicateTable(DuplicateMarker.merge_distance,
+        getattr(args, 'umi_method', barcode.EXACT), getattr(args, 'umi_distance', 1),
+        rg_tag=TAG_RG, mc_tag=TAG_COUNT)
+    inp = bamio.open_bam(args.input, 'rb', args)
+    for (i, entry) in enumerate(metrics.read_input(inp, args.input)):
+        if (i % 100000) == 0:
+            log.info('pass one: read %(i)s reads' % locals())
+        table.add(entry)
+    inp.close()
 
-                current = [positions.pop(0)]
-            else:
-                break
+    state = metrics.timer('dedup', table.mark)()
+
+    log.info('pass two: writing %s reads' % len(state))
+    inp = bamio.open_bam(args.input, 'rb', args)
+    outp = bamio.open_output(args.output, args, template=inp)
+    write = metrics.timer('write', outp.write)
+    for (entry, s) in itertools.izip(metrics.iterate('read', inp), state):
+        if s == duptable.DROP:
+            continue
+        if s == duptable.DUPLICATE:
+            entry.is_duplicate = True
+        write(entry)
+    outp.close()
+
+    _report_duplicates(table.counts, sys.stderr)
 
-        #for nondup in filter_dups(group, current):
-        #    log.debug('writing read')
-        #    outp.write(nondup)
-#
 
+def pipeline(args):
+    """ Annotate, clip and mark duplicates in a single pass.
 
+        Takes the annotate options.  Reads matching an expected amplicon are
+        clipped to its trim coordinates (use --no-clip to skip), using the EA
+        tags already in the input when --amps is not given.  Duplicates are
+        then marked using the RG and MC tags, as by the duplicates command,
+        and written to one output.
 
+        WARNING: this unsorts your input and holds every read in memory
+    """
+    path = args.input
+    inp = args.input = bamio.open_bam(args.input, args=args)
+    header = inp.header
+
+    args.clip = not args.no_clip
+    annotators = _load_annotators(args, header)
+    clipper = None
+    if args.clip and not args.amps and 'CO' in header:
+        clipper = clip.AmpliconClipper(args, header)
+
+    assert 'SQ' in header # http://code.google.com/p/pysam/issues/detail?id=84
+
+    marker = DuplicateMarker(args.umi_method, args.umi_distance)
+    clip_read = metrics.timer('clip', clipper.clip_read) if clipper else None
+    add = metrics.timer('dedup', marker.add)
+    # reads kept by the annotators and the clipper
+    kept = [0]
+    def clip_and_mark(read):
+        if clipper is None or clip_read(read):
+            kept[0] += 1
+            add(read)
+
+    log.info('begin read annotation')
+    processed, _ = _annotate_reads(annotators, metrics.read_input(inp, path), clip_and_mark)
+    included = kept[0]
+
+    oup = bamio.open_output(args.output, args, header=header)
+    write = metrics.timer('write', oup.write)
+    for read in metrics.iterate('dedup', marker.finish()):
+        write(read)
+    oup.close()
+
+    for a in annotators:
+        a.report()
+    if clipper:
+        clipper.stats.report(sys.stdout)
+
+    print 'processed {0} reads, kept {1} ({2} %)'.format(processed, included, 100*float(included)/processed)
+    marker.report(sys.stdout)
@@ -0,0 +1,46 @@
+"""
+Open BAM files with the compression and threading options shared by the
+subcommands.
+"""
+import logging; log = logging.getLogger(__name__)
+
+
+def customize_parser(parser, output=True):
+    group = parser.add_argument_group('BAM compression')
+    group.add_argument('--threads', type=int, default=1,
+            help='threads for BGZF compression and decompression (default 1)')
+    if output:
+        # pysam rejects the modes wb1 to wb9, so only level 0 can be chosen
+        group.add_argument('--compression-level', type=int, choices=(0,),
+                help='output compression level, only 0 (stored BGZF blocks) is '
+                'supported by pysam (default pysam default)')
+        group.add_argument('--uncompressed', '-u', action='store_true',
+                help='write uncompressed BAM, e.g. when piping into another amptools command')
+
+
+def write_mode(args):
+    """ return the pysam mode for writing BAM output with args """
+    if getattr(args, 'uncompressed', False):
+        return 'wbu'
+    level = getattr(args, 'compression_level', None)
+    if level is not None:
+        return 'wb%d' % level
+    return 'wb'
+
+
+def open_bam(path, mode='r', args=None, **kwargs):
+    """ open a BAM file, using the number of threads in args """
+    # imported here so commands that do not read BAM start quickly
+    import pysam
+    threads = getattr(args, 'threads', 1)
+    if threads > 1:
+        try:
+            return pysam.Samfile(path, mode, threads=threads, **kwargs)
+        except TypeError:
+            log.warning('this version of pysam does not support threads, using one')
+    return pysam.Samfile(path, mode, **kwargs)
+
+
+def open_output(path, args, **kwargs):
+    """ open BAM output with the compression in args """
+    return open_bam(path, write_mode(args), args, **kwargs)
@@ -0,0 +1,164 @@
+"""
+Error tolerant lookup of read barcodes in a barcode whitelist.
+"""
+from collections import defaultdict, OrderedDict
+
+HAMMING = 'hamming'
+EDIT = 'edit'
+METRICS = (HAMMING, EDIT)
+
+
+def hamming(a, b):
+    """ number of mismatches between two sequences of the same length """
+    return sum(1 for (x, y) in zip(a, b) if x != y)
+
+
+def levenshtein(a, b):
+    """ number of substitutions, insertions and deletions between a and b """
+    if len(a) < len(b):
+        a, b = b, a
+    previous = range(len(b) + 1)
+    for (i, x) in enumerate(a):
+        current = [i + 1]
+        for (j, y) in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (x != y)))
+        previous = current
+    return previous[-1]
+
+
+def _deletions(seq, k):
+    """ all sequences made by deleting up to k bases from seq """
+    found = set([seq])
+    last = found
+    for _ in range(k):
+        last = set(x[:i] + x[i+1:] for x in last for i in range(len(x)))
+        found |= last
+    return found
+
+
+class BarcodeIndex(object):
+    """ Find the whitelist barcodes within max_distance of a read barcode.
+
+        For Hamming distance the barcodes are split into max_distance + 1
+        segments, one of which must match exactly, and each segment is
+        indexed.  For edit distance the index holds every barcode with up to
+        max_distance bases deleted, and a read barcode is a candidate for any
+        barcode that shares one of these deletions.  Candidates are then
+        checked with the full distance.
+    """
+
+    def __init__(self, barcodes, max_distance=1, metric=HAMMING):
+        if metric not in METRICS:
+            raise ValueError('unknown barcode distance %s' % metric)
+        self.barcodes = sorted(set(barcodes))
+        self.max_distance = max_distance
+        self.metric = metric
+        self._index = defaultdict(list)
+
+        for (i, bc) in enumerate(self.barcodes):
+            for key in self._keys(bc):
+                self._index[key].append(i)
+
+    def _segments(self, length):
+        k = self.max_distance + 1
+        return [(length * i // k, length * (i + 1) // k) for i in range(k)]
+
+    def _keys(self, seq):
+        if self.metric == EDIT:
+            return _deletions(seq, self.max_distance)
+        return [(len(seq), s, seq[s:e]) for (s, e) in self._segments(len(seq))]
+
+    def neighbours(self, seq):
+        """ return [(distance, barcode)] for barcodes within max_distance """
+        candidates = set()
+        for key in self._keys(seq):
+            candidates.update(self._index.get(key, ()))
+
+        distance = levenshtein if self.metric == EDIT else hamming
+        found = []
+        for i in candidates:
+            bc = self.barcodes[i]
+            d = distance(seq, bc)
+            if d <= self.max_distance:
+                found.append((d, bc))
+        return sorted(found)
+
+    def search(self, seq):
+        """ return the closest barcode, or None if there is none or a tie """
+        found = self.neighbours(seq)
+        if not found or (len(found) > 1 and found[0][0] == found[1][0]):
+            return None
+        return found[0][1]
+
+
+class LRUCache(object):
+    """ Dictionary holding at most size items, dropping the least recently used.
+
+        Counts hits and misses so the size can be tuned from real data.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+
+EXACT = 'exact'
+DIRECTIONAL = 'directional'
+CLUSTER_METHODS = (EXACT, HAMMING, DIRECTIONAL)
+
+
+def cluster(counts, max_distance=1, method=DIRECTIONAL):
+    """ Group sequences that differ by sequencing errors.
+
+        counts is a dictionary of {sequence: reads}.  With the hamming method
+        sequences within max_distance mismatches of each other are linked and
+        each connected group is one cluster.  The directional method only
+        links a to b when a has at least 2 * reads(b) - 1 reads, so two
+        abundant sequences one mismatch apart stay separate.  Returns
+        {sequence: representative}, the representative being the most
+        abundant sequence of its cluster.
+    """
+    if method not in CLUSTER_METHODS:
+        raise ValueError('unknown clustering method %s' % method)
+    if method == EXACT or len(counts) < 2:
+        return dict((seq, seq) for seq in counts)
+
+    index = BarcodeIndex(counts, max_distance)
+    representative = {}
+    # most abundant first, ties broken by sequence so the result is stable
+    for root in sorted(counts, key=lambda x: (-counts[x], x)):
+        if root in representative:
+            continue
+        representative[root] = root
+        todo = [root]
+        while todo:
+            seq = todo.pop()
+            for (_, other) in index.neighbours(seq):
+                if other in representative:
+                    continue
+                if method == DIRECTIONAL and counts[seq] < 2 * counts[other] - 1:
+                    continue
+                representative[other] = root
+                todo.append(other)
+    return representative
@@ -2,7 +2,7 @@
 Methods for handling cigar lists.
 
 Pysam returns a list of [operation, bases] representing the alignment of a
-read to a reference
+read to a reference.
 """
 from __future__ import print_function
 import sys
@@ -16,41 +16,93 @@ SKIP = 3
 SOFT_CLIP = 4
 HARD_CLIP = 5
 PADDING = 6
+SEQ_MATCH = 7
+SEQ_MISMATCH = 8
+
+# operations aligning a read base to a reference base
+ALIGNED = (MATCH, SEQ_MATCH, SEQ_MISMATCH)
 
 # indexes of operation or number of bases
 OP = 0
 BASES = 1
 
+# operations counted by read_length and ref_length, indexed by operation
+READ_BASES = (1, 1, 0, 0, 1, 0, 0, 0, 0)
+REF_BASES = (1, 0, 1, 0, 0, 0, 0, 0, 0)
+
 
 def read_length(cigar):
     """ Return the number of read bases represented by cigar """
-    return sum(
-        [
-            x[BASES] for x in cigar
-            if x[OP] in [MATCH, INS, SOFT_CLIP]
-
-        ]
-    )
+    return sum([bases for (op, bases) in cigar if READ_BASES[op]])
 
 def ref_length(cigar):
     """ Return the number of reference bases represented by the cigar """
-    return sum(
-        [x[BASES] for x in cigar
-        if x[OP] in [MATCH, DEL]]
-    )
+    return sum([bases for (op, bases) in cigar if REF_BASES[op]])
+
+def aligned_indexes(cigar, pos, targets):
+    """ Return the index among the aligned read bases of the base aligned to
+        each reference position in targets, or None where no base is.
+
+        This is read.positions.index(target) for a read at pos, found in one
+        walk of the cigar.
+    """
+    found = [None] * len(targets)
+    last = max(targets)
+    ref = pos
+    aligned = 0
+    for (op, bases) in cigar:
+        if ref > last:
+            break
+        if op in ALIGNED:
+            for (i, target) in enumerate(targets):
+                if ref <= target < ref + bases:
+                    found[i] = aligned + target - ref
+            ref += bases
+            aligned += bases
+        elif op in (DEL, SKIP):
+            ref += bases
+    return found
+
+def read_indexes(cigar, pos, targets):
+    """ Return the index in the read sequence, soft clips included, of the
+        base aligned to each reference position in targets, or None where
+        no base is.
+    """
+    found = [None] * len(targets)
+    last = max(targets)
+    ref = pos
+    index = 0
+    for (op, bases) in cigar:
+        if ref > last:
+            break
+        if op in ALIGNED:
+            for (i, target) in enumerate(targets):
+                if ref <= target < ref + bases:
+                    found[i] = index + target - ref
+            ref += bases
+            index += bases
+        elif op in (DEL, SKIP):
+            ref += bases
+        elif op in (INS, SOFT_CLIP):
+            index += bases
+    return found
 
 def remove_soft(cigar, seq, qual):
-    """ Remove soft clipped bases from a cigar string and sequence """
+    """ Remove soft clipped bases from a cigar string and sequence
+
+        Returns a new cigar, leaving the one passed in unchanged.
+    """
+    start, end = 0, len(cigar)
     if cigar[0][OP] == SOFT_CLIP:
-        sc = cigar.pop(0)
-        seq = seq[sc[BASES]:]
-        qual = qual[sc[BASES]:]
+        start = 1
+        seq = seq[cigar[0][BASES]:]
+        qual = qual[cigar[0][BASES]:]
     if cigar[-1][OP] == SOFT_CLIP:
-        sc = cigar.pop()
-        seq = seq[:-sc[BASES]]
-        qual = qual[:-sc[BASES]]
+        end -= 1
+        seq = seq[:-cigar[-1][BASES]]
+        qual = qual[:-cigar[-1][BASES]]
 
-    return cigar, seq, qual
+    return cigar[start:end], seq, qual
 
 def trim_cigar(cigar, n, start=False):
     """ Trim cigar until it represents n read bases, inserting hard clips
@@ -58,66 +110,53 @@ def trim_cigar(cigar, n, start=False):
         Defaults to trimming at the 3' end of the read, set start=True to
         trim from the 5' end (start) of the read
     """
-    # if we need to trim from the start, reverse the cigar, trim and reverse the result
-    if start:
-        cigar = list(reversed(cigar))
-        cigar = trim_cigar(cigar, n)
-        return list(reversed(cigar))
-
     # check we can handle these ops
-    all_ops = [x[OP] for x in cigar]
-    if PADDING in all_ops or SKIP in all_ops:
-        raise NotImplementedError
+    for (op, _) in cigar:
+        if op == PADDING or op == SKIP:
+            raise NotImplementedError
 
     to_trim = read_length(cigar) - n
     if to_trim == 0:
-        return cigar
+        return list(cigar)
 
-    # cache the clips
-    start_clip, end_clip = [], [(HARD_CLIP, 0)]
+    # work from the end being trimmed
+    if start:
+        cigar = cigar[::-1]
 
+    # cache the clips
+    first, last = 0, len(cigar)
+    start_clip, clipped = [], to_trim
     if cigar[0][OP] == HARD_CLIP:
-        start_clip = [cigar.pop(0)]
-    if cigar[-1][OP] ==  HARD_CLIP:
-        end_clip = [cigar.pop()]
+        start_clip = [cigar[0]]
+        first = 1
+    if cigar[-1][OP] == HARD_CLIP:
+        last -= 1
+        clipped += cigar[-1][BASES]
 
     assert to_trim > 0
-    end_clip = [(HARD_CLIP, end_clip[0][BASES] + to_trim)]
-
+    partial = []
     while to_trim:
+        op, bases = cigar[last - 1]
+        last -= 1
 
-        op = cigar[-1][OP]
-        bases = cigar[-1][BASES]
-
-        if op in [MATCH, INS, SOFT_CLIP]:
-
-            # not enough bases
-            if bases - to_trim < 0:
-                to_trim = to_trim - bases
-                cigar.pop()
-
-            # exact number of bases
-            elif bases - to_trim == 0:
+        if op == MATCH or op == INS or op == SOFT_CLIP:
+            # too many bases, keep the rest of the element
+            if bases > to_trim:
+                partial = [(op, bases - to_trim)]
                 to_trim = 0
-                cigar.pop()
-
-            # too many bases
             else:
-                # print 'trimmed', to_trim
-                cigar[-1] = (op, bases - to_trim)
-                to_trim = 0
-
+                to_trim -= bases
 
-        elif op == DEL:
-            cigar.pop()
-
-        else:
-            raise Exception('bad cigar element in trimming: %s' % cigar[-1])
+        elif op != DEL:
+            raise Exception('bad cigar element in trimming: %s' % (cigar[last],))
 
     # remove final deletions as they will affect the placement of
     # reversed reads
-    while cigar[-1][OP] == DEL:
-        cigar.pop()
+    if not partial:
+        while cigar[last - 1][OP] == DEL:
+            last -= 1
 
-    assert read_length(cigar) == n, '%s is not length %s' % (cigar, n)
-    return start_clip + cigar + end_clip
+    trimmed = start_clip + cigar[first:last] + partial + [(HARD_CLIP, clipped)]
+    if start:
+        trimmed.reverse()
+    return trimmed
@@ -1,7 +1,9 @@
+import os
 import sys
 
-import pysam
-
+import bamio
+import metrics
+import parallel
 import stats
 import amplicon
 
@@ -19,31 +21,82 @@ class AmpliconClipper(object):
         parser.add_argument('--pe', action='store_true', help='fix for pe single primer')
 
 
-    def __init__(self, args):
+    def __init__(self, args, header=None):
         self.args = args
         self.stats = stats.Stats('')
-        self.samfile = pysam.Samfile(args.input)
-        self.amplicons = amplicon.load_amplicons_from_header(self.samfile.header, self.stats, self.samfile)
+        if header is None:
+            header = bamio.open_bam(args.input).header
+        self.amplicons = amplicon.load_amplicons_from_header(header, self.stats, None)
 
         self.amplicons = dict([(x.external_id, x) for x in self.amplicons])
 
+    def clip_read(self, r):
+        """ clip r to its EA amplicon, returns False for primer only reads """
+        EA = dict(r.tags).get('ea', None)
+        if EA is not None:
+            clipped = self.amplicons[EA].clip(r)
+            return bool(clipped or self.args.pe)
+        return True
+
     def __call__(self, samfile, outfile):
+        clip_read = metrics.timer('clip', self.clip_read)
+        write = metrics.timer('write', outfile.write)
         for r in samfile:
-            EA = dict(r.tags).get('ea', None)
-            if EA is not None:
-                clipped = self.amplicons[EA].clip(r)
-                if clipped or self.args.pe:
-                    outfile.write(r)
-            else:
-                outfile.write(r)
+            if clip_read(r):
+                write(r)
+
+
+# clipper and input shared with forked shard workers
+_shard_state = {}
+
+def _clip_shard(job):
+    """ clip one shard of the input into its own BAM """
+    i, start, end, shard_path = job
+    clipper, args = _shard_state['clipper'], _shard_state['args']
+    clipper.stats.reset()
+
+    inp = bamio.open_bam(_shard_state['path'])
+    oup = bamio.open_output(shard_path, args, template=inp)
+    clipper(parallel.iter_shard(inp, start, end), oup)
+    oup.close()
+    inp.close()
+
+    return shard_path, clipper.stats
+
+
+def _clip_sharded(path, inp, clipper, args):
+    """ clip shards of the input in worker processes, merging in input order """
+    shards = parallel.plan_shards(inp, path, args.workers * 4)
+    _shard_state.update(clipper=clipper, path=path, args=args)
+
+    oup = parallel.OrderedMerge(args.output, inp.header, args)
+    try:
+        pool = parallel.ShardPool(args.workers)
+        for (shard_path, shard_stats) in pool.imap(_clip_shard, shards):
+            clipper.stats.merge(shard_stats)
+            oup.append(shard_path)
+            os.unlink(shard_path)
+    finally:
+        _shard_state.clear()
+    oup.close()
 
 
 def clip(args):
-    """ clip primer sequences from amptools annotated BAM """
-    inp = pysam.Samfile(args.input, 'rb')
-    oup = pysam.Samfile(args.output, 'wb', template=inp)
+    """ clip primer sequences from amptools annotated BAM
+
+        Use --workers to clip shards of the input in several processes, the
+        output keeps the input order.
+    """
+    inp = bamio.open_bam(args.input, 'rb', args)
+    clipper = AmpliconClipper(args, inp.header)
 
-    clipper = AmpliconClipper(args)
-    clipper(inp, oup)
+    if getattr(args, 'workers', 1) > 1:
+        if args.input == '-':
+            raise Exception('--workers needs an input file, not a stream')
+        _clip_sharded(args.input, inp, clipper, args)
+    else:
+        oup = bamio.open_output(args.output, args, template=inp)
+        clipper(metrics.read_input(inp, args.input), oup)
+        oup.close()
     clipper.stats.report(sys.stdout)
 
@@ -0,0 +1,327 @@
+"""
+Read counts and depth for each read group and amplicon of an annotated BAM.
+"""
+from __future__ import print_function, division
+import logging; log = logging.getLogger(__name__)
+
+from collections import Counter
+import array
+import csv
+import sys
+
+import numpy as np
+
+import amplicon
+import bamio
+import parallel
+from stats import Stats
+
+
+def _count_amplicons(samfile, amplicons, depth=None):
+    """ count the reads and unique reads of each (RG, amplicon) by fetching
+        the amplicon regions, adding the reads to depth if given
+    """
+    reads, uniq = Counter(), Counter()
+    references = set(samfile.references)
+    for amp in amplicons:
+        if amp.chr not in references:
+            log.warning('amplicon %s is on %s, which is not in the BAM' % (amp.external_id, amp.chr))
+            continue
+        for r in samfile.fetch(amp.chr, amp.start, amp.end):
+            tags = dict(r.tags)
+            # reads overlapping more than one amplicon are counted for their own
+            if tags.get('ea') != amp.external_id or 'RG' not in tags:
+                continue
+            key = tags['RG'], amp.external_id
+            reads[key] += 1
+            if not r.is_duplicate:
+                uniq[key] += 1
+            if depth is not None:
+                depth.add(amp.external_id, r)
+    return reads, uniq
+
+
+# amplicons and input shared with forked workers
+_coverage_state = {}
+
+def _coverage_shard(job):
+    i, amp_ids, _ = job
+    amplicons = [_coverage_state['amplicons'][x] for x in amp_ids]
+    depth = DepthProfile(amplicons) if _coverage_state['depth'] else None
+    samfile = bamio.open_bam(_coverage_state['path'])
+    reads, uniq = _count_amplicons(samfile, amplicons, depth)
+    samfile.close()
+    if depth is not None:
+        depth.flush()
+    return reads, uniq, depth
+
+
+def _indexed_coverage(args, inp, amplicons, depth=None):
+    """ count reads per (RG, amplicon) from the amplicon regions of an indexed BAM
+
+        Returns (total, reads, uniq) with total from the index statistics.
+    """
+    if args.input == '-' or not parallel.index_file(args.input):
+        raise Exception('--indexed needs an indexed BAM file')
+
+    mapped, unmapped = parallel.read_counts(args.input)
+    workers = getattr(args, 'workers', 1)
+    if workers <= 1:
+        reads, uniq = _count_amplicons(inp, amplicons, depth)
+        return mapped + unmapped, reads, uniq
+
+    # spread the amplicons over the workers in a few batches each
+    nbatches = min(len(amplicons), workers * 4) or 1
+    batches = [(range(i, len(amplicons), nbatches),) for i in range(nbatches)]
+    _coverage_state.update(amplicons=amplicons, path=args.input, depth=depth is not None)
+    reads, uniq = Counter(), Counter()
+    try:
+        for (r, u, d) in parallel.ShardPool(workers).imap(_coverage_shard, batches):
+            reads.update(r)
+            uniq.update(u)
+            if depth is not None:
+                depth.merge(d)
+    finally:
+        _coverage_state.clear()
+    return mapped + unmapped, reads, uniq
+
+
+class CoverageMatrix(object):
+    """ Reads and unique reads for each read group and amplicon.
+
+        Read groups and amplicons are given integer indexes, in sorted order,
+        and counted in dense arrays of read groups by amplicons.  Reads are
+        buffered as flat indexes and added to the arrays in batches.
+    """
+
+    BATCH = 1 << 20
+
+    def __init__(self, rgs, amps):
+        self.rgs = sorted(set(rgs))
+        self.amps = sorted(set(amps))
+        self.rg_index = dict((x, i) for (i, x) in enumerate(self.rgs))
+        self.amp_index = dict((x, i) for (i, x) in enumerate(self.amps))
+        self.reads = np.zeros((len(self.rgs), len(self.amps)), dtype=np.int64)
+        self.uniq = np.zeros_like(self.reads)
+        self._reads = array.array('l')
+        self._uniq = array.array('l')
+
+    def index(self, rg, amp):
+        """ return the flat index of (rg, amp), or None if either is unknown """
+        i, j = self.rg_index.get(rg), self.amp_index.get(amp)
+        if i is None or j is None:
+            return None
+        return i * len(self.amps) + j
+
+    def add(self, rg, amp, is_duplicate):
+        k = self.index(rg, amp)
+        if k is None:
+            logging.debug('unexpected key')
+            return
+        self._reads.append(k)
+        if not is_duplicate:
+            self._uniq.append(k)
+        if len(self._reads) >= self.BATCH:
+            self.flush()
+
+    def add_counts(self, reads, uniq):
+        """ add dictionaries of {(rg, amp): count} """
+        for (key, n) in reads.items():
+            k = self.index(*key)
+            if k is None:
+                logging.debug('unexpected key')
+                continue
+            self.reads.flat[k] += n
+            self.uniq.flat[k] += uniq.get(key, 0)
+
+    def flush(self):
+        size = self.reads.size
+        for (counts, buffered) in ((self.reads, self._reads), (self.uniq, self._uniq)):
+            if len(buffered):
+                found = np.bincount(np.frombuffer(buffered, dtype=np.int_), minlength=size)
+                counts += found.reshape(counts.shape)
+                del buffered[:]
+
+    def rg_reads(self, rg):
+        """ total reads of a read group """
+        i = self.rg_index.get(rg)
+        return 0 if i is None else int(self.reads[i].sum())
+
+    def save(self, path, libs):
+        """ write the counts and their labels to a numpy .npz file """
+        self.flush()
+        np.savez(path, reads=self.reads, unique=self.uniq, rgs=np.array(self.rgs),
+            amplicons=np.array(self.amps), libraries=np.array([str(libs[x]) for x in self.rgs]))
+
+
+class DepthProfile(object):
+    """ Depth at each base of the trim region of each amplicon.
+
+        Each read adds a start event where it enters the trim region and an
+        end event where it leaves it.  The events are kept in a difference
+        array for all the trim regions, one base longer than each region, and
+        the depths are its cumulative sum, so no pileup is needed.  Depth is
+        counted for all reads and for reads not marked as duplicates, over
+        the reference bases each read spans.
+    """
+
+    BATCH = 1 << 20
+    # bases below this fraction of the mean depth count against uniformity
+    UNIFORM_FRACTION = 0.2
+
+    def __init__(self, amplicons):
+        self.amps = [a.external_id for a in amplicons]
+        self.index = dict((x, i) for (i, x) in enumerate(self.amps))
+        self.trim_starts = [a.trim_start for a in amplicons]
+        self.trim_ends = [a.trim_end for a in amplicons]
+        self.lengths = np.array([e - s for (s, e) in zip(self.trim_starts, self.trim_ends)], dtype=np.int64)
+        # each region and its end event slot start at offsets[i]
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths + 1)))
+        self.diff = np.zeros((2, self.offsets[-1]), dtype=np.int64)
+        self._events = [array.array('l') for _ in range(4)]
+
+    def add(self, amp, read):
+        i = self.index.get(amp)
+        if i is None:
+            return
+        start = max(read.pos, self.trim_starts[i])
+        end = min(read.aend, self.trim_ends[i])
+        if end <= start:
+            return
+
+        base = self.offsets[i] - self.trim_starts[i]
+        events = self._events
+        events[0].append(base + start)
+        events[1].append(base + end)
+        if not read.is_duplicate:
+            events[2].append(base + start)
+            events[3].append(base + end)
+        if len(events[0]) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        size = self.diff.shape[1]
+        for (k, events) in enumerate(self._events):
+            if len(events):
+                found = np.bincount(np.frombuffer(events, dtype=np.int_), minlength=size)
+                # starts add and ends take away
+                self.diff[k // 2] += found if k % 2 == 0 else -found
+                del events[:]
+
+    def merge(self, other):
+        """ add the events of a profile over some of the same amplicons """
+        other.flush()
+        for (j, amp) in enumerate(other.amps):
+            i = self.index[amp]
+            self.diff[:, self.offsets[i]:self.offsets[i + 1]] += \
+                other.diff[:, other.offsets[j]:other.offsets[j + 1]]
+
+    def depths(self):
+        """ return the (all reads, unique reads) depth arrays of every trim
+            region joined together, region i starting at offsets[i] - i
+        """
+        self.flush()
+        # every region's events cancel out, so one cumulative sum works
+        keep = np.ones(self.diff.shape[1], dtype=bool)
+        keep[self.offsets[1:] - 1] = False
+        depth = np.cumsum(self.diff, axis=1)[:, keep]
+        return depth[0], depth[1]
+
+    def summary(self, depth):
+        """ return the mean depth, minimum depth and uniformity of each
+            region, uniformity being the fraction of bases at or above
+            UNIFORM_FRACTION of the mean
+        """
+        region = np.repeat(np.arange(len(self.amps)), self.lengths)
+        lengths = np.maximum(self.lengths, 1)
+        mean = np.bincount(region, weights=depth, minlength=len(self.amps)) / lengths
+        starts = self.offsets[:-1] - np.arange(len(self.amps))
+        minimum = np.zeros(len(self.amps), dtype=np.int64)
+        nonempty = self.lengths > 0
+        if nonempty.any():
+            minimum[nonempty] = np.minimum.reduceat(depth, starts[nonempty])
+        uniform = depth >= self.UNIFORM_FRACTION * mean[region]
+        uniformity = np.bincount(region, weights=uniform, minlength=len(self.amps)) / lengths
+        return mean, minimum, uniformity
+
+    def save(self, path):
+        """ write the depths and summary of each amplicon to a numpy .npz file """
+        depth, unique = self.depths()
+        mean, minimum, uniformity = self.summary(unique)
+        np.savez(path, amplicons=np.array(self.amps), trim_starts=np.array(self.trim_starts),
+            offsets=self.offsets[:-1] - np.arange(len(self.amps)), depth=depth,
+            unique_depth=unique, mean=mean, min=minimum, uniformity=uniformity)
+        return mean, minimum, uniformity
+
+
+def coverage(args):
+    """ Report reads and unique reads for each read group and amplicon.
+
+        Use --indexed with an indexed BAM to only read the amplicon regions,
+        taking the total number of reads from the index, and --workers to
+        count the amplicons in several processes.  --matrix also writes the
+        counts as arrays of read groups by amplicons to a numpy .npz file.
+        --depth writes the depth at each base of each amplicon's trim region,
+        with the mean, minimum and uniformity of the unique read depth.
+    """
+    inp = bamio.open_bam(args.input, args=args)
+
+    total = 0
+    stats = Stats('')
+    amplicons = amplicon.load_amplicons_from_header(inp.header, stats, None)
+    libs = {}
+
+    for rg in inp.header['RG']:
+        libs[rg['ID']] = rg.get('LB', None)
+    matrix = CoverageMatrix(libs, [amp.external_id for amp in amplicons])
+    depth = DepthProfile(amplicons) if getattr(args, 'depth', None) else None
+
+    if getattr(args, 'indexed', False):
+        total, found_reads, found_uniq = _indexed_coverage(args, inp, amplicons, depth)
+        matrix.add_counts(found_reads, found_uniq)
+    else:
+        for r in inp:
+            total += 1
+            tags = dict(r.tags)
+            try:
+                rg, ea = tags['RG'], tags['ea']
+            except KeyError:
+                continue
+            matrix.add(rg, ea, r.is_duplicate)
+            if depth is not None:
+                depth.add(ea, r)
+    matrix.flush()
+
+    total_ot = int(matrix.reads.sum())
+    total_uniq = int(matrix.uniq.sum())
+
+    total_ot_p = (100.0 * total_ot) / total
+
+    try:
+        reads_per_counter = float(total_ot) / total_uniq
+    except ZeroDivisionError:
+        reads_per_counter = 0
+
+    print('total %(total)s reads, on target %(total_ot)s, uniq %(total_uniq)s' % locals(), file=sys.stderr)
+    print('on target %3.2f%%' % total_ot_p, file=sys.stderr)
+    print('on target reads per counter: %2.2f' % reads_per_counter, file=sys.stderr)
+
+    if args.control:
+        total_control = matrix.rg_reads(args.control)
+        control_p = (100*total_control)/total
+        print('control reads %(total_control)s, %(control_p)f%%' % locals(), file=sys.stderr)
+
+    if getattr(args, 'matrix', None):
+        matrix.save(args.matrix, libs)
+
+    if depth is not None:
+        mean, minimum, uniformity = depth.save(args.depth)
+        dropouts = np.count_nonzero(minimum < DepthProfile.UNIFORM_FRACTION * mean)
+        print('amplicons with partial dropout: %s of %s' % (dropouts, len(mean)), file=sys.stderr)
+
+    out = csv.writer(sys.stdout)
+    out.writerow(['rg', 'lib', 'amp', 'unique', 'reads'])
+    for (i, rg) in enumerate(matrix.rgs):
+        if rg != args.control:
+            for (j, amp) in enumerate(matrix.amps):
+                out.writerow(map(str, (rg, libs[rg], amp, matrix.uniq[i, j], matrix.reads[i, j])))
@@ -0,0 +1,138 @@
+"""
+Compact table of the fields duplicate marking needs from each read.
+
+Duplicates are decided from the reference, orientation, start, mapping
+quality, read group and molecular counter of each read, so a first pass over
+a BAM only stores these in arrays of a few bytes per read, indexed by the
+read's position in the file.  The decisions are then applied to the reads
+on a second pass.
+"""
+import array
+from collections import Counter
+import logging; log = logging.getLogger(__name__)
+
+import numpy as np
+
+import barcode
+
+# the state of each read after marking
+DROP = 0
+UNIQUE = 1
+DUPLICATE = 2
+
+
+class DuplicateTable(object):
+    """ Mark duplicates like annotate.DuplicateMarker without holding reads.
+
+        Reads are added in file order and mark() returns an array with the
+        state (DROP, UNIQUE or DUPLICATE) of each of them.  Reads without RG
+        or MC tags are dropped, as by DuplicateMarker.
+    """
+
+    def __init__(self, merge_distance, umi_method=barcode.EXACT, umi_distance=1,
+            rg_tag='RG', mc_tag='mc'):
+        self.merge_distance = merge_distance
+        self.umi_method = umi_method
+        self.umi_distance = umi_distance
+        self.rg_tag = rg_tag
+        self.mc_tag = mc_tag
+        self.counts = Counter()
+
+        self.rgs = {}
+        self.mcs = {}
+        self._rname = array.array('i')
+        self._reverse = array.array('b')
+        self._start = array.array('i')
+        self._mapq = array.array('B')
+        self._rg = array.array('i')
+        self._mc = array.array('i')
+
+    def __len__(self):
+        return len(self._rname)
+
+    def add(self, entry):
+        is_reverse = entry.is_reverse
+        start = entry.aend if is_reverse else entry.pos
+        self._rname.append(entry.rname)
+        self._reverse.append(is_reverse)
+        self._start.append(entry.pos if start is None else start)
+        self._mapq.append(entry.mapq)
+        try:
+            rg, mc = entry.opt(self.rg_tag), entry.opt(self.mc_tag)
+            self._rg.append(self.rgs.setdefault(rg, len(self.rgs)))
+            self._mc.append(self.mcs.setdefault(mc, len(self.mcs)))
+        except KeyError:
+            self._rg.append(-1)
+            self._mc.append(-1)
+        self.counts['reads'] += 1
+
+    def _chains(self, rname, reverse, start):
+        """ number the runs of start positions within merge_distance of each other """
+        order = np.lexsort((start, reverse, rname))
+        s = start[order]
+        new_chain = np.ones(len(order), dtype=bool)
+        new_chain[1:] = (rname[order][1:] != rname[order][:-1]) | \
+            (reverse[order][1:] != reverse[order][:-1]) | \
+            (s[1:] - s[:-1] > self.merge_distance)
+        chains = np.empty(len(order), dtype=np.int64)
+        chains[order] = np.cumsum(new_chain) - 1
+        return chains
+
+    def _cluster_counters(self, chain, rg, mc):
+        """ replace each counter with the representative of its cluster """
+        mc = mc.copy()
+        names = [None] * len(self.mcs)
+        for (name, i) in self.mcs.items():
+            names[i] = name
+        ids = self.mcs
+
+        order = np.lexsort((mc, rg, chain))
+        keys = np.column_stack((chain[order], rg[order]))
+        bounds = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+        for group in np.split(order, bounds):
+            values, counts = np.unique(mc[group], return_counts=True)
+            if len(values) < 2:
+                continue
+            representative = barcode.cluster(
+                dict((names[v], int(c)) for (v, c) in zip(values, counts)),
+                self.umi_distance, self.umi_method)
+            lookup = dict((v, ids[representative[names[v]]]) for v in values)
+            mc[group] = [lookup[v] for v in mc[group]]
+        return mc
+
+    def mark(self):
+        """ return the state of each read added, in the order they were added """
+        n = len(self)
+        state = np.zeros(n, dtype=np.uint8)
+        if not n:
+            return state
+
+        rname = np.frombuffer(self._rname, dtype=np.int32)
+        reverse = np.frombuffer(self._reverse, dtype=np.int8)
+        start = np.frombuffer(self._start, dtype=np.int32).astype(np.int64)
+        mapq = np.frombuffer(self._mapq, dtype=np.uint8)
+        rg = np.frombuffer(self._rg, dtype=np.int32)
+        mc = np.frombuffer(self._mc, dtype=np.int32)
+
+        chain = self._chains(rname, reverse, start)
+        tagged = np.flatnonzero(rg >= 0)
+        self.counts['missing tags'] += n - len(tagged)
+        if not len(tagged):
+            return state
+
+        chain, start, mapq, rg, mc = chain[tagged], start[tagged], mapq[tagged], rg[tagged], mc[tagged]
+        if self.umi_method != barcode.EXACT:
+            mc = self._cluster_counters(chain, rg, mc)
+
+        # within each group the best mapping quality wins, ties going to the
+        # last read by start and file order as in DuplicateMarker
+        order = np.lexsort((tagged, start, mapq, mc, rg, chain))
+        keys = np.column_stack((chain[order], rg[order], mc[order]))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = np.any(keys[1:] != keys[:-1], axis=1)
+
+        state[tagged] = DUPLICATE
+        state[tagged[order[last]]] = UNIQUE
+        self.counts['unique'] += int(last.sum())
+        self.counts['duplicates'] += len(order) - int(last.sum())
+        return state
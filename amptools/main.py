@@ -6,28 +6,55 @@ molecular counters and clip primer sequences.
 import argparse
 import sys
 import annotate
+import bamio
 import clip
-import stats
+import trimindex
+
+
+def lazy_command(module, name):
+    """ return a command that imports module when it runs, for commands with
+        dependencies that are slow to import
+    """
+    def command(args):
+        return getattr(__import__(module, globals()), name)(args)
+    command.__name__ = name
+    return command
 
 
 parser = argparse.ArgumentParser(prog='amptools', description=sys.modules[__name__].__doc__)
 parser.add_argument('--version', action='version', version='%(prog)s 0.1.1')
 
 parser.add_argument('--profile', action='store_true', help='run with profiling')
+parser.add_argument('--metrics', type=str,
+        help='write reads/s, time per stage and peak memory to this JSON file')
+parser.add_argument('--progress', type=float, default=0,
+        help='report reads/s and ETA on stderr every this many seconds')
 parser.add_argument('--verbose', '-v', action='count', help='verbosity (use -vv for debug)')
 subparsers = parser.add_subparsers(help='sub-command help')
 
+def add_annotator_arguments(parser):
+    parser.add_argument('--adaptor', type=str, help='Adaptor in barcode/counter file.  Use B for barcode bases and M for molecular counter bases')
+    trim_lookup = parser.add_mutually_exclusive_group()
+    trim_lookup.add_argument('--stream-trim', action='store_true',
+            help='Walk barcode/counter files alongside the BAM instead of preloading them (BAM in read order)')
+    trim_lookup.add_argument('--trim-index', action='store_true',
+            help='Look up barcodes/counters in a memory mapped index, built next to each file if missing')
+    parser.add_argument('--trim-lookahead', type=int, default=100000,
+            help='Trim file lines to buffer for reads out of order when streaming (default 100000)')
+    annotate.MidAnnotator.customize_parser(parser)
+    annotate.AmpliconAnnotator.customize_parser(parser)
+    annotate.DbrAnnotator.customize_parser(parser)
+    bamio.customize_parser(parser)
+
 # annotate command
 parser_a = subparsers.add_parser('annotate', description=annotate.annotate.__doc__,
         help='annotate a BAM file with tags')
 parser_a.set_defaults(func=annotate.annotate)
 parser_a.add_argument('input', type=str, help='input BAM file')
 parser_a.add_argument('--output', type=str, help='output BAM file (default stdout)', default='-')
-
-parser_a.add_argument('--adaptor', type=str, help='Adaptor in barcode/counter file.  Use B for barcode bases and M for molecular counter bases')
-annotate.MidAnnotator.customize_parser(parser_a)
-annotate.AmpliconAnnotator.customize_parser(parser_a)
-annotate.DbrAnnotator.customize_parser(parser_a)
+parser_a.add_argument('--workers', type=int, default=1,
+        help='annotate shards of the input in this many processes (default 1)')
+add_annotator_arguments(parser_a)
 
 # duplicates command
 parser_c = subparsers.add_parser('duplicates', description=annotate.duplicates.__doc__,
@@ -35,6 +62,15 @@ parser_c = subparsers.add_parser('duplicates', description=annotate.duplicates._
 parser_c.set_defaults(func=annotate.duplicates)
 parser_c.add_argument('input', type=str, help='input BAM file')
 parser_c.add_argument('--output', type=str, help='output BAM file (default stdout)', default='-')
+dedup_mode = parser_c.add_mutually_exclusive_group()
+dedup_mode.add_argument('--sorted', action='store_true',
+        help='input is coordinate sorted, mark duplicates while reading and keep the output sorted')
+dedup_mode.add_argument('--two-pass', action='store_true',
+        help='read the input twice to mark duplicates in less memory, keeping the input order')
+parser_c.add_argument('--workers', type=int, default=1,
+        help='mark each reference of an indexed BAM in one of this many processes (default 1)')
+annotate.DuplicateMarker.customize_parser(parser_c)
+bamio.customize_parser(parser_c)
 
 # clip command
 parser_b = subparsers.add_parser('clip', description=clip.clip.__doc__,
@@ -42,10 +78,39 @@ parser_b = subparsers.add_parser('clip', description=clip.clip.__doc__,
 parser_b.set_defaults(func=clip.clip)
 parser_b.add_argument('input', type=str, help='input file')
 parser_b.add_argument('--output', type=str, help='output file', default='-')
+parser_b.add_argument('--workers', type=int, default=1,
+        help='clip shards of the input in this many processes (default 1)')
 clip.AmpliconClipper.customize_parser(parser_b)
+bamio.customize_parser(parser_b)
+
+# pipeline command
+parser_p = subparsers.add_parser('pipeline', description=annotate.pipeline.__doc__,
+        help='annotate, clip and mark duplicates in one pass')
+parser_p.set_defaults(func=annotate.pipeline)
+parser_p.add_argument('input', type=str, help='input BAM file')
+parser_p.add_argument('--output', type=str, help='output BAM file (default stdout)', default='-')
+parser_p.add_argument('--no-clip', action='store_true', help='do not clip reads to their amplicon')
+annotate.DuplicateMarker.customize_parser(parser_p)
+add_annotator_arguments(parser_p)
+
+# index-trim command
+parser_t = subparsers.add_parser('index-trim', description=trimindex.index_trim.__doc__,
+        help='index a barcode/counter file for annotate --trim-index')
+parser_t.set_defaults(func=trimindex.index_trim)
+parser_t.add_argument('input', type=str, help='barcode or counter trim file')
+parser_t.add_argument('--output', type=str, help='index file (default INPUT%s)' % trimindex.SUFFIX)
 
 parser_cov = subparsers.add_parser('coverage', help='coverage')
-parser_cov.set_defaults(func=stats.coverage)
+parser_cov.set_defaults(func=lazy_command('coverage', 'coverage'))
 parser_cov.add_argument('input', type=str, help='input file')
 parser_cov.add_argument('--control', type=str, help='control RG')
+parser_cov.add_argument('--indexed', action='store_true',
+        help='only read the amplicon regions of an indexed BAM')
+parser_cov.add_argument('--workers', type=int, default=1,
+        help='with --indexed, count amplicons in this many processes (default 1)')
+parser_cov.add_argument('--matrix', type=str,
+        help='also write the read group by amplicon counts to this numpy .npz file')
+parser_cov.add_argument('--depth', type=str,
+        help='also write the depth over each amplicon trim region to this numpy .npz file')
+bamio.customize_parser(parser_cov, output=False)
 
@@ -0,0 +1,221 @@
+"""
+Stage timings, throughput and memory for a command, with progress lines.
+
+Metrics are off unless the amptools script calls start(), and the functions
+below then return what they are given, so the read loops pay nothing.  Loops
+that would need an extra call per read to be timed check enabled().  When
+they are on, each stage call costs a counter and two clock reads, and the
+memory is only read for progress lines and the report.  Timing a sample of
+the calls instead was no cheaper and much less accurate, as a sampled call
+that met a garbage collection was counted many times.  Forked workers keep
+their own copy, so with --workers each job returns its stages and counts to
+the parent to be merged, and stage seconds are summed over the workers.
+"""
+from __future__ import print_function, division
+import json
+import resource
+import sys
+import time
+from collections import Counter, OrderedDict
+
+import parallel
+
+# check the clock for progress lines once in this many reads
+PROGRESS_CHECK = 4096
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Metrics(object):
+
+    def __init__(self, command, progress=0, stream=sys.stderr):
+        self.command = command
+        self.progress = progress
+        self.stream = stream
+        self.start = self._last_progress = time.time()
+        self.reads = 0
+        self.total = None
+        self.counts = Counter()
+        # stage -> [calls, seconds]
+        self.stages = OrderedDict()
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage, [0, 0.0])
+
+    def timer(self, stage, func):
+        """ return func, timing its calls as stage """
+        s = self._stage(stage)
+        clock = time.time
+
+        def timed(*args):
+            begin = clock()
+            try:
+                return func(*args)
+            finally:
+                s[0] += 1
+                s[1] += clock() - begin
+        return timed
+
+    def iterate(self, stage, iterable):
+        """ iterate over iterable, timing each step as stage """
+        s = self._stage(stage)
+        clock = time.time
+        step = iter(iterable).next
+        while True:
+            begin = clock()
+            try:
+                item = step()
+            except StopIteration:
+                s[1] += clock() - begin
+                return
+            s[0] += 1
+            s[1] += clock() - begin
+            yield item
+
+    def take(self):
+        """ return the stages and counts so far, starting new ones """
+        taken = (self.stages, self.counts)
+        self.stages = OrderedDict()
+        self.counts = Counter()
+        return taken
+
+    def merge(self, taken):
+        """ add stages and counts returned by take(), e.g. in a worker """
+        stages, counts = taken
+        for (stage, (calls, seconds)) in stages.items():
+            s = self._stage(stage)
+            s[0] += calls
+            s[1] += seconds
+        self.counts.update(counts)
+
+    def read_input(self, iterable, total=None):
+        """ iterate over the input reads, counting them for the throughput """
+        self.total = total
+        reads = self.reads
+        for read in self.iterate('read', iterable):
+            reads += 1
+            if not reads % PROGRESS_CHECK:
+                self.reads = reads
+                self.check_progress()
+            yield read
+        self.reads = reads
+
+    def advance(self, reads):
+        """ count reads handled elsewhere, e.g. by a worker """
+        self.reads += reads
+        self.check_progress()
+
+    def check_progress(self):
+        if self.progress and time.time() - self._last_progress >= self.progress:
+            self.report_progress()
+
+    def report_progress(self):
+        now = self._last_progress = time.time()
+        elapsed = now - self.start
+        rate = self.reads / elapsed if elapsed else 0
+        line = '%s: %s reads in %s, %.0f reads/s, peak RSS %.0f MB' % (
+            self.command, self.reads, _format_seconds(elapsed), rate, _peak_rss_mb())
+        if self.total and rate:
+            remaining = max(self.total - self.reads, 0) / rate
+            line += ', %.1f%% done, ETA %s' % (
+                min(100 * self.reads / self.total, 100), _format_seconds(remaining))
+        print(line, file=self.stream)
+
+    def report(self):
+        """ return the metrics as a dictionary """
+        elapsed = time.time() - self.start
+        stages = OrderedDict()
+        for (stage, (calls, seconds)) in self.stages.items():
+            stages[stage] = OrderedDict([
+                ('calls', calls),
+                ('seconds', seconds),
+                ('us_per_call', 1e6 * seconds / calls if calls else 0.0),
+            ])
+        return OrderedDict([
+            ('command', self.command),
+            ('reads', self.reads),
+            ('total_reads', self.total),
+            ('seconds', elapsed),
+            ('reads_per_second', self.reads / elapsed if elapsed else 0.0),
+            ('stages', stages),
+            ('counts', dict(self.counts)),
+            ('peak_rss_mb', _peak_rss_mb()),
+            ('peak_rss_children_mb', _peak_rss_mb(resource.RUSAGE_CHILDREN)),
+        ])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+# the metrics of the running command, None when off
+_metrics = None
+
+def start(command, progress=0):
+    global _metrics
+    _metrics = Metrics(command, progress)
+    return _metrics
+
+def finish(path=None):
+    """ write the metrics to path and report the final progress line """
+    global _metrics
+    if _metrics is None:
+        return
+    if _metrics.progress:
+        _metrics.report_progress()
+    if path:
+        _metrics.save(path)
+    _metrics = None
+
+def enabled():
+    return _metrics is not None
+
+def timer(stage, func):
+    if _metrics is None:
+        return func
+    return _metrics.timer(stage, func)
+
+def iterate(stage, iterable):
+    if _metrics is None:
+        return iterable
+    return _metrics.iterate(stage, iterable)
+
+def read_input(iterable, path=None):
+    """ count and time the reads of the input, estimating the total from the
+        index of path when it has one
+    """
+    if _metrics is None:
+        return iterable
+    total = None
+    if path and path != '-' and parallel.index_file(path):
+        total = sum(parallel.read_counts(path))
+    return _metrics.read_input(iterable, total)
+
+def advance(reads):
+    if _metrics is not None:
+        _metrics.advance(reads)
+
+def take():
+    """ return the stages and counts of this process since the last take(),
+        for a worker to return to the parent, or None when off
+    """
+    if _metrics is None:
+        return None
+    return _metrics.take()
+
+def merge(taken):
+    if _metrics is not None and taken is not None:
+        _metrics.merge(taken)
+
+def count(name, n=1):
+    if _metrics is not None:
+        _metrics.counts[name] += n
@@ -0,0 +1,273 @@
+"""
+Split BAM files into shards of consecutive records for parallel processing.
+
+A shard is a range of BGZF virtual offsets [start, end) that begins on a
+record.  Shards are planned from the record offsets stored in the BAM index
+(.bai) when there is one, otherwise from offsets noted during a quick pass
+over the file, and together they cover every record exactly once.  Results
+are gathered in shard order so merged output keeps the input order.
+"""
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import multiprocessing
+from bisect import bisect_left
+import logging; log = logging.getLogger(__name__)
+
+import bamio
+import metrics
+
+BAI_MAGIC = 'BAI\1'
+# samtools stores mapped/unmapped counts for a reference in this bin
+BAI_PSEUDO_BIN = 37450
+# reads between recorded offsets when planning shards without an index
+SKIM_READS = 100000
+# empty block marking the end of a BGZF file
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def index_file(path):
+    """ return the path of the BAM index for path, or None """
+    for bai in (path + '.bai', os.path.splitext(path)[0] + '.bai'):
+        if os.path.exists(bai):
+            return bai
+    return None
+
+
+def _read_bai(bai):
+    """ return the (begin, end) virtual offsets of the record chunks in a BAM
+        index, the offsets in its linear index and the (mapped, unmapped)
+        read counts, where unmapped includes reads without a reference
+    """
+    data = open(bai, 'rb').read()
+    if data[:4] != BAI_MAGIC:
+        raise Exception('%s is not a BAM index' % bai)
+
+    chunks = []
+    linear = []
+    mapped = unmapped = 0
+    (n_ref,) = struct.unpack_from('<i', data, 4)
+    p = 8
+    for _ in xrange(n_ref):
+        (n_bin,) = struct.unpack_from('<i', data, p)
+        p += 4
+        for _ in xrange(n_bin):
+            bin, n_chunk = struct.unpack_from('<Ii', data, p)
+            p += 8
+            if bin != BAI_PSEUDO_BIN:
+                offsets = struct.unpack_from('<%dQ' % (2 * n_chunk), data, p)
+                chunks.extend(zip(offsets[::2], offsets[1::2]))
+            else:
+                # the second chunk holds the read counts
+                counts = struct.unpack_from('<QQ', data, p + 16)
+                mapped += counts[0]
+                unmapped += counts[1]
+            p += 16 * n_chunk
+        (n_intv,) = struct.unpack_from('<i', data, p)
+        p += 4
+        linear.extend(struct.unpack_from('<%dQ' % n_intv, data, p))
+        p += 8 * n_intv
+
+    # optional count of reads without a reference
+    if len(data) >= p + 8:
+        unmapped += struct.unpack_from('<Q', data, p)[0]
+
+    return chunks, linear, (mapped, unmapped)
+
+
+def read_counts(path):
+    """ return the (mapped, unmapped) read counts from the index of path """
+    return _read_bai(index_file(path))[2]
+
+
+def _read_bai_offsets(bai):
+    """ return the record start virtual offsets held in a BAM index """
+    chunks, linear, _ = _read_bai(bai)
+    return [begin for (begin, _) in chunks] + linear
+
+
+def unplaced_offset(samfile, path):
+    """ return the virtual offset after the last read placed on a reference
+
+        Only the unplaced unmapped reads, which come last in a sorted BAM,
+        follow this offset.  samfile must be positioned at the first record.
+    """
+    chunks, _, _ = _read_bai(index_file(path))
+    if not chunks:
+        return samfile.tell()
+    return max(end for (_, end) in chunks)
+
+
+def iter_unplaced(samfile, start):
+    """ iterate the reads without a reference from offset start """
+    for read in iter_shard(samfile, start, None):
+        if read.tid < 0:
+            yield read
+
+
+def _skim_offsets(samfile, every=None):
+    """ return the offsets of every nth record, reading the whole file """
+    every = every or SKIM_READS
+    offsets = []
+    n = 0
+    while True:
+        pos = samfile.tell()
+        try:
+            samfile.next()
+        except StopIteration:
+            break
+        if n % every == 0:
+            offsets.append(pos)
+        n += 1
+    return offsets
+
+
+def plan_shards(samfile, path, nshards):
+    """ return a list of (start, end) virtual offsets covering every record
+
+        samfile must be positioned at the first record and is left there.
+        The last shard has an end of None and runs to the end of the file.
+    """
+    first = samfile.tell()
+    bai = index_file(path)
+    points = []
+    if bai:
+        points = sorted(set(x for x in _read_bai_offsets(bai) if x > first))
+    if len(points) < nshards:
+        log.info('reading {0} to plan shards'.format(path))
+        points = _skim_offsets(samfile)[1:]
+        samfile.seek(first)
+
+    # pick split points evenly spaced in the compressed file
+    size = os.path.getsize(path)
+    blocks = [x >> 16 for x in points]
+    splits = [first]
+    for i in range(1, nshards):
+        j = bisect_left(blocks, (first >> 16) + (size - (first >> 16)) * i // nshards)
+        if j < len(points) and points[j] > splits[-1]:
+            splits.append(points[j])
+
+    return zip(splits, splits[1:] + [None])
+
+
+def iter_shard(samfile, start, end):
+    """ iterate the records of samfile with virtual offsets in [start, end) """
+    samfile.seek(start)
+    while end is None or samfile.tell() < end:
+        try:
+            yield samfile.next()
+        except StopIteration:
+            return
+
+
+def _run_job(job):
+    """ run func on a job in a worker, returning the metrics of the job too """
+    func, job = job
+    # drop the metrics inherited from the parent or left by an earlier job
+    metrics.take()
+    result = func(job)
+    return result, metrics.take()
+
+
+class ShardPool(object):
+    """ Run a function over shards in worker processes.
+
+        Workers are forked, so state set up before the pool is created (for
+        example loaded annotators) is shared with them.  Each call gets
+        (index, start, end, path) for a shard (start, end), or more generally
+        the index, the items of the shard and path, where path is a temporary
+        file for the shard output.  Results are returned in shard order, and
+        the metrics of each call are added to those of this process.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.tmpdir = tempfile.mkdtemp(prefix='amptools')
+
+    def shard_path(self, i):
+        return os.path.join(self.tmpdir, 'shard%05d.bam' % i)
+
+    def imap(self, func, shards):
+        jobs = [(i,) + tuple(shard) + (self.shard_path(i),) for (i, shard) in enumerate(shards)]
+        log.info('processing {0} shards with {1} workers'.format(len(jobs), self.workers))
+
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            for (result, taken) in pool.imap(_run_job, [(func, job) for job in jobs]):
+                metrics.merge(taken)
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class OrderedMerge(object):
+    """ Write the shard BAMs of one input to a single output, in order.
+
+        Shards should be written with bamio.open_output and args.  When the shard headers
+        end on a BGZF block boundary the record blocks of each shard are
+        copied without recompressing them, otherwise the reads are rewritten.
+    """
+
+    def __init__(self, path, header, args):
+        self.path = path
+        self.header = header
+        self.args = args
+        self.out = None
+
+    def _open(self, shard_path, first):
+        self.copy_blocks = not (first & 0xffff)
+        if self.copy_blocks:
+            self.out = sys.stdout if self.path == '-' else open(self.path, 'wb')
+            self.out.write(open(shard_path, 'rb').read(first >> 16))
+        else:
+            self.out = bamio.open_output(self.path, self.args, header=self.header)
+
+    def append(self, shard_path):
+        shard = bamio.open_bam(shard_path)
+        first = shard.tell()
+        try:
+            read = shard.next()
+        except StopIteration:
+            return
+
+        if self.out is None:
+            self._open(shard_path, first)
+
+        if not self.copy_blocks:
+            self.out.write(read)
+            for read in shard:
+                self.out.write(read)
+            return
+
+        assert not (first & 0xffff), 'shard %s header not block aligned' % shard_path
+        shard.close()
+        inp = open(shard_path, 'rb')
+        inp.seek(first >> 16)
+        size = os.path.getsize(shard_path) - (first >> 16) - len(BGZF_EOF)
+        while size > 0:
+            data = inp.read(min(size, 1 << 22))
+            self.out.write(data)
+            size -= len(data)
+        assert inp.read() == BGZF_EOF, 'truncated shard %s' % shard_path
+        inp.close()
+
+    def close(self):
+        if self.out is None:
+            # no reads in any shard
+            bamio.open_output(self.path, self.args, header=self.header).close()
+        elif not self.copy_blocks:
+            self.out.close()
+        else:
+            self.out.write(BGZF_EOF)
+            if self.out is sys.stdout:
+                self.out.flush()
+            else:
+                self.out.close()
@@ -1,14 +1,9 @@
 from __future__ import print_function, division
 import logging; log = logging.getLogger(__name__)
 
-from collections import Counter
+from collections import Counter, namedtuple
 import csv
 import sys
-from rpy2 import robjects
-from rpy2.robjects.packages import importr
-import amplicon
-
-import pysam
 
 class Stats(object):
 
@@ -29,6 +24,20 @@ class Stats(object):
     def match(self, eid):
         self._matches[eid] += 1
 
+    def reset(self):
+        """ zero the counts, keeping the amplicon ids """
+        self._start_trims.clear()
+        self._end_trims.clear()
+        self._matches.clear()
+        self.reads = 0
+
+    def merge(self, other):
+        """ add the counts from another Stats, e.g. from a worker process """
+        self._start_trims.update(other._start_trims)
+        self._end_trims.update(other._end_trims)
+        self._matches.update(other._matches)
+        self.reads += other.reads
+
     def report(self, stream):
 
         print('amptools version xx', file=stream)
@@ -51,113 +60,195 @@ class Stats(object):
 
 
 
-ll_test = robjects.r('''
-function(ra, aa, gt, diag=F) {
-    ra_sum = sum(ra)
-    aa_sum = sum(aa)
-    ab = aa_sum / (ra_sum + aa_sum)
-    gtp = 0.5 + (0.48*(gt-1))
-
-    error_likelihood = log(dbinom(aa, ra+aa, ab))
-    gt_likelihood = log(dbinom(aa, ra+aa, gtp))
-
-    if (diag) {
-        print(ra)
-        print(aa)
-        print(gtp)
-        print(ab)
-        print(error_likelihood)
-        print(gt_likelihood)
-    }
-    error_likelihood = sum(error_likelihood)
-    gt_likelihood = sum(gt_likelihood)
-    if (F) {
-        print(error_likelihood)
-        print(gt_likelihood)
-
-        print(exp(error_likelihood))
-        print(exp(gt_likelihood))
-    }
-    c(error_likelihood - gt_likelihood, ab)
-}
-''')
+def _binom_logpmf(k, n, p):
+    from scipy.stats import binom
+    return binom.logpmf(k, n, p)
+
+def ll_tests(ra, aa, gt, called=None):
+    """ log likelihood test of many sites at once.
+
+        ra, aa and gt are sites by samples arrays of reference counts,
+        alternate counts and genotypes (0, 1 or 2 alternate alleles).  Samples
+        where called is False are left out of their site.  Returns arrays of
+        the test value, which is negative when the genotypes explain the
+        counts better than a single allele balance does, and of the allele
+        balance of each site.
+    """
+    import numpy as np
+    ra, aa, gt = [np.atleast_2d(np.asarray(x, dtype=float)) for x in (ra, aa, gt)]
+    if called is None:
+        called = np.ones(ra.shape, dtype=bool)
+    called = np.atleast_2d(called)
+    ra, aa = np.where(called, ra, 0), np.where(called, aa, 0)
+    depth = ra + aa
+
+    aa_sum = aa.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ab = aa_sum / depth.sum(axis=1)
+        gtp = 0.5 + 0.48 * (gt - 1)
+
+        error_likelihood = _binom_logpmf(aa, depth, ab[:, np.newaxis])
+        gt_likelihood = _binom_logpmf(aa, depth, gtp)
+    error_likelihood = np.where(called, error_likelihood, 0).sum(axis=1)
+    gt_likelihood = np.where(called, gt_likelihood, 0).sum(axis=1)
+    return error_likelihood - gt_likelihood, ab
+
+def ll_test(ra, aa, gt, diag=False):
+    """ log likelihood test of one site, returns the test value and allele balance """
+    test_vals, abs_ = ll_tests([ra], [aa], [gt])
+    if diag:
+        print(ra, aa, gt, file=sys.stderr)
+        print(test_vals[0], abs_[0], file=sys.stderr)
+    return test_vals[0], abs_[0]
 
 def bias_test(calls):
 
-
     calls = [x for x in calls if x.called]
 
     #TODO: single genotype assumption
     try:
         # freebayes
-        ra = robjects.IntVector([x['RO'][0] for x in calls])
-        aa = robjects.IntVector([x['AO'][0] for x in calls])
+        ra = [x['RO'][0] for x in calls]
+        aa = [x['AO'][0] for x in calls]
     except KeyError:
         # GATK
-        ra = robjects.IntVector([x['AD'][0] for x in calls ])
-        aa = robjects.IntVector([x['AD'][1] for x in calls ])
+        ra = [x['AD'][0] for x in calls ]
+        aa = [x['AD'][1] for x in calls ]
 
 
-    gt = robjects.IntVector([x.gt_type for x in calls])
-    # print(ra, aa, gt)
+    gt = [x.gt_type for x in calls]
     test_val, ab = ll_test(ra, aa, gt)
     #print('test value -ve prefers gt, +ve prefers error', test_val, test_val < 0, ab)
 
     return test_val < 0, test_val, ab
 
-def neg_binom_fit(reads):
-    robjects.r.options(warn=-1)
-    reads = robjects.IntVector(reads)
-    mass = importr('MASS')
-    fit = mass.fitdistr(reads, 'negative binomial')
-    print('Negative binomial fit:')
-    print(fit)
-    qvals = robjects.FloatVector([0,0.01,0.05,0.1,0.25,0.5])
-    print('Quantiles:')
-    print(robjects.r.quantile(reads, qvals))
-
-
-def _cluster_center(calls):
-    if not calls: return None
-    ra = sum([x['RO'] for x in calls])
-    aa = sum([x['AO'] for x in calls])
-    return ra / (ra + aa)
-
-def _mean_distance_to_center(calls):
-    if not calls: return None
-    center = _cluster_center(calls)
-    for x in calls:
-        if x['RO'] + x['AO'] == 0:
-            print ('x'*80, '\n', x)
-    posns = [(x['RO']/( x['RO'] + x['AO'] )) for x in calls if (x['RO'] + x['AO']) > 0 ]
-    dists = [abs(x - center) for x in posns]
-    return sum(dists) / len(dists)
+NB_QUANTILES = (0, 0.01, 0.05, 0.1, 0.25, 0.5)
+
+NegBinomFit = namedtuple('NegBinomFit', 'size mu quantiles')
+
+def _neg_binom_score(counts, size, mu):
+    """ derivative of the negative binomial log likelihood in log(size), and
+        its own derivative
+    """
+    import numpy as np
+    from scipy.special import digamma, polygamma
+    n = counts.shape[1]
+    r = size[:, np.newaxis]
+    score = (digamma(counts + r).sum(axis=1) - n * digamma(size)
+            + n * np.log(size / (size + mu)))
+    slope = (polygamma(1, counts + r).sum(axis=1) - n * polygamma(1, size)
+            + n * mu / (size * (size + mu)))
+    return score * size, (score + slope * size) * size
+
+def neg_binom_fits(counts, quantiles=NB_QUANTILES, tol=1e-8, max_iter=100):
+    """ maximum likelihood negative binomial fits of the rows of counts, e.g.
+        the reads on each amplicon of many samples.
+
+        The mean is the row mean and the size is found by Newton's method on
+        log(size), falling back to bisection when a step leaves the bracket
+        around the root.  Rows with no more variance than a Poisson have an
+        infinite size.  Returns arrays of the sizes and means and of the
+        quantiles of each row.
+    """
+    import numpy as np
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    mu = counts.mean(axis=1)
+    var = counts.var(axis=1)
+    size = np.empty(len(counts))
+    size.fill(np.inf)
+
+    fit = var > mu
+    if fit.any():
+        x, m = counts[fit], mu[fit]
+        lo = np.empty(len(x))
+        lo.fill(np.log(1e-8))
+        hi = np.empty(len(x))
+        hi.fill(np.log(1e8))
+        # start from the method of moments estimate
+        t = np.clip(np.log(m * m / (var[fit] - m)), lo, hi)
+        active = np.ones(len(x), dtype=bool)
+        for _ in range(max_iter):
+            score, slope = _neg_binom_score(x[active], np.exp(t[active]), m[active])
+            # the score falls as the size grows, so the root is above t
+            # while the score is positive
+            up = score > 0
+            lo[active] = np.where(up, t[active], lo[active])
+            hi[active] = np.where(up, hi[active], t[active])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = t[active] - score / slope
+            bad = ~((step > lo[active]) & (step < hi[active]))
+            step[bad] = (lo[active][bad] + hi[active][bad]) / 2
+            done = np.abs(step - t[active]) < tol
+            t[active] = step
+            active[active] = ~done
+            if not active.any():
+                break
+        size[fit] = np.where(t >= np.log(1e8) - tol, np.inf, np.exp(t))
+
+    return NegBinomFit(size, mu, np.percentile(counts, [100 * q for q in quantiles], axis=1).T)
+
+def neg_binom_fit(reads, quantiles=NB_QUANTILES):
+    """ negative binomial fit of one read count distribution, see neg_binom_fits """
+    size, mu, qvals = neg_binom_fits([reads], quantiles)
+    return NegBinomFit(size[0], mu[0], qvals[0])
+
+
+GENOTYPES = {(0, 0): 0, (0, 1): 1, (1, 1): 2}
+
+def cluster_separations(ro, ao, gt):
+    """ cluster separation score of many sites at once.
+
+        ro, ao and gt are sites by samples arrays of reference counts,
+        alternate counts and genotypes (0, 1 or 2 alternate alleles, anything
+        else is ignored).  Samples are clustered by genotype on their
+        reference allele fraction, and each pair of neighbouring clusters
+        scores the sum of their mean distances to their centre over the
+        distance between the centres.  The score of a site is the worst pair,
+        or 0 when no pair has two clusters.  Samples with no reads are left
+        out, and clusters with the same centre score infinity.
+    """
+    import numpy as np
+    ro, ao, gt = [np.atleast_2d(np.asarray(x, dtype=float)) for x in (ro, ao, gt)]
+    depth = ro + ao
+    covered = depth > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(covered, ro / depth, 0)
+
+        centers, spreads, present = [], [], []
+        for g in range(3):
+            member = covered & (gt == g)
+            n = member.sum(axis=1)
+            center = np.where(member, ro, 0).sum(axis=1) / np.where(member, depth, 0).sum(axis=1)
+            spread = np.where(member, np.abs(frac - center[:, np.newaxis]), 0).sum(axis=1) / n
+            centers.append(center)
+            spreads.append(spread)
+            present.append(n > 0)
+
+        values = np.zeros(len(ro))
+        for (left, right) in [(0, 1), (1, 2)]:
+            score = (spreads[left] + spreads[right]) / np.abs(centers[left] - centers[right])
+            score[np.isnan(score)] = np.inf
+            values = np.where(present[left] & present[right], np.maximum(values, score), values)
+    return values
 
 def cluster_separation(calls):
+    """ cluster separation score of the calls at one site, see cluster_separations """
+    ro = [x['RO'] for x in calls]
+    ao = [x['AO'] for x in calls]
+    gt = [GENOTYPES.get(x['GT'], -1) for x in calls]
+    return cluster_separations([ro], [ao], [gt])[0]
 
-    hom = [x for x in calls if x['GT'] == (0,0)]
-    het = [x for x in calls if x['GT'] == (0,1)]
-    var = [x for x in calls if x['GT'] == (1,1)]
-
-    # print('dist', len(hom), len(het), len(var))
-
-    values = [0]
-    for (left, right) in [(hom, het), (het, var)]:
-        left_center, right_center = _cluster_center(left), _cluster_center(right)
-        if left_center is None or right_center is None:
-            continue
-        dist_between_means = abs(left_center - right_center)
-        score = _mean_distance_to_center(left) + _mean_distance_to_center(right)
-        score = score / dist_between_means
-        values.append(score)
-    # print('vals', values)
-
-    return max(values)
 
+AMP_BIAS_P = (0.01, 0.5, 0.99)
 
-amp_bias_test = ('''
-function(AOs, DPs) {which.max(c(dbinom(AOs, DPs, 0.01),  dbinom(AOs, DPs, 0.5), dbinom(AOs, DPs, 0.99))) - 1}
-''')
+def amp_bias_test(AOs, DPs):
+    """ most likely genotype (0, 1 or 2 alternate alleles) for each pair of
+        alternate and total counts
+    """
+    import numpy as np
+    AOs, DPs = np.asarray(AOs), np.asarray(DPs)
+    likelihoods = [_binom_logpmf(AOs, DPs, p) for p in AMP_BIAS_P]
+    return np.atleast_1d(np.argmax(likelihoods, axis=0))
 
 def check_amplicon_bias(calls, counts, amps, amp_counter):
     """Iterate through a number of VCF calls and write AMPC into each record in place.
@@ -165,89 +256,28 @@ def check_amplicon_bias(calls, counts, amps, amp_counter):
         the call for the amplicon matches the overall call.
      """
 
-    # this R callout needs to be vectorized
     for call in calls:
         if call['_GT'] is None:
             continue
 
         gt = sum(call['_GT'])
 
-        supporting = 0
-        ampcount = 0
+        covered, aos, dps = [], [], []
         for amp in amps:
             ro = counts.get((call['name'], amp, True), 0)
             ao = counts.get((call['name'], amp, False), 0)
-            # print ('test', call['name'], amp, ao, ao+ro, amp_bias_test(ao, ao+ro)[0])
-
             if ro + ao > 0:
-                ampcount += 1
-                if amp_bias_test(ao, ao+ro)[0] == gt:
+                covered.append(amp)
+                aos.append(ao)
+                dps.append(ao + ro)
+
+        supporting = 0
+        if covered:
+            for (amp, amp_gt) in zip(covered, amp_bias_test(aos, dps)):
+                if amp_gt == gt:
                     supporting += 1
                 else:
                     amp_counter[amp] += 1
 
-
         call['AMPS'] = supporting
-        call['AMPC'] = ampcount
-
-
-
-
-def coverage(args):
-    counts = {}
-    inp = pysam.Samfile(args.input)
-
-    uniq = {}
-    reads = {}
-
-    total = 0
-    stats = Stats('')
-    amplicons = amplicon.load_amplicons_from_header(inp.header, stats, None)
-    libs = {}
-
-    for rg in inp.header['RG']:
-        for amp in amplicons:
-            key = rg['ID'], amp.external_id
-            reads[key] = uniq[key] = 0
-            libs[rg['ID']] = rg.get('LB', None)
-
-    for r in inp:
-        total += 1
-        tags = dict(r.tags)
-        try:
-            key = tags['RG'], tags['ea']
-        except KeyError:
-            continue
-        try:
-            reads[key] += 1
-            if not r.is_duplicate:
-                uniq[key] += 1
-        except KeyError:
-            logging.debug('unexpected key')
-
-    total_ot = sum(reads.values())
-    total_uniq = sum(uniq.values())
-
-    total_ot_p = (100.0 * total_ot) / total
-
-    try:
-        reads_per_counter = float(total_ot) / total_uniq
-    except ZeroDivisionError:
-        reads_per_counter = 0
-
-    print('total %(total)s reads, on target %(total_ot)s, uniq %(total_uniq)s' % locals(), file=sys.stderr)
-    print('on target %3.2f%%' % total_ot_p, file=sys.stderr)
-    print('on target reads per counter: %2.2f' % reads_per_counter, file=sys.stderr)
-
-    if args.control:
-        total_control = sum([reads[x] for x in reads if x[0] == args.control])
-        control_p = (100*total_control)/total
-        print('control reads %(total_control)s, %(control_p)f%%' % locals(), file=sys.stderr)
-
-    out = csv.writer(sys.stdout)
-    out.writerow(['rg', 'lib', 'amp', 'unique', 'reads'])
-    for (rg, amp) in sorted(reads):
-        if rg != args.control:
-            key = (rg, amp)
-            out.writerow(map(str, (rg, libs[rg], amp, uniq[key], reads[key])))
-
+        call['AMPC'] = len(covered)
@@ -0,0 +1,151 @@
+"""
+Compact on-disk index of cutadapt trim files.
+
+A trim file of (sequence, accession) lines is turned into a table of 64-bit
+accession hashes sorted for binary search, a parallel table of sequence ids
+and the list of distinct sequences.  The tables are memory mapped, so lookups
+do not hold the accessions in memory and several processes annotating the
+same run share the same pages.
+"""
+from __future__ import print_function
+import os
+import sys
+import array
+import struct
+import hashlib
+import logging; log = logging.getLogger(__name__)
+
+MAGIC = 'AMPTIX01'
+HEADER = struct.Struct('<8sQQ')
+SUFFIX = '.tix'
+
+
+def qname_hash(qname):
+    """ stable signed 64-bit hash of a read accession """
+    return struct.unpack('<q', hashlib.md5(qname).digest()[:8])[0]
+
+
+def index_path(trim_file):
+    return trim_file + SUFFIX
+
+
+def build_index(trim_file, index_file=None):
+    """ build the index for trim_file, returns the index path """
+    import numpy as np
+    index_file = index_file or index_path(trim_file)
+    log.info('indexing file {0}'.format(trim_file))
+
+    hashes = array.array('l')
+    values = array.array('I')
+    value_ids = {}
+    assert hashes.itemsize == 8, 'need 64-bit longs to build index'
+
+    for line in file(trim_file):
+        try:
+            mid, accession = line.rstrip().split(' ', 1)
+        except ValueError, e:
+            raise Exception('could not parse file %s: %s' % (trim_file, e))
+        hashes.append(qname_hash(accession))
+        try:
+            values.append(value_ids[mid])
+        except KeyError:
+            values.append(value_ids.setdefault(mid, len(value_ids)))
+
+    hashes = np.frombuffer(hashes, dtype=np.int64)
+    values = np.frombuffer(values, dtype=np.uint32)
+    order = np.argsort(hashes, kind='mergesort')
+    hashes, values = hashes[order], values[order]
+
+    collisions = np.count_nonzero(hashes[1:] == hashes[:-1])
+    if collisions:
+        log.warning('{0} repeated accession hashes in {1}, first entry used'.format(
+            collisions, trim_file))
+
+    distinct = [None] * len(value_ids)
+    for (mid, i) in value_ids.items():
+        distinct[i] = mid
+
+    # write to a temporary file so a partial index is never opened
+    tmp = '%s.%s.tmp' % (index_file, os.getpid())
+    with open(tmp, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, len(hashes), len(distinct)))
+        hashes.astype('<i8').tofile(out)
+        values.astype('<u4').tofile(out)
+        out.write('\n'.join(distinct))
+    os.rename(tmp, index_file)
+
+    log.info('indexed {0} reads, {1} distinct sequences'.format(len(hashes), len(distinct)))
+    return index_file
+
+
+class TrimIndex(object):
+    """ Memory mapped lookup of sequences by read accession.
+
+        Supports the same lookups as the dictionary returned by
+        annotate._read_trim_file, raising KeyError for unknown reads.
+    """
+
+    def __init__(self, index_file):
+        import numpy as np
+        self.index_file = index_file
+        with open(index_file, 'rb') as inp:
+            magic, n, nvalues = HEADER.unpack(inp.read(HEADER.size))
+            if magic != MAGIC:
+                raise Exception('%s is not an amptools trim index' % index_file)
+            inp.seek(HEADER.size + 12 * n)
+            self.values = inp.read().split('\n')[:nvalues]
+
+        self._n = n
+        if n:
+            self._hashes = np.memmap(index_file, dtype='<i8', mode='r',
+                offset=HEADER.size, shape=(n,))
+            self._ids = np.memmap(index_file, dtype='<u4', mode='r',
+                offset=HEADER.size + 8 * n, shape=(n,))
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, qname):
+        h = qname_hash(qname)
+        if self._n:
+            i = self._hashes.searchsorted(h)
+            if i < self._n and self._hashes[i] == h:
+                return self.values[self._ids[i]]
+        raise KeyError(qname)
+
+    def __contains__(self, qname):
+        try:
+            self[qname]
+            return True
+        except KeyError:
+            return False
+
+
+def is_index(path):
+    with open(path, 'rb') as inp:
+        return inp.read(len(MAGIC)) == MAGIC
+
+
+def open_index(trim_file):
+    """ open the index for trim_file, building it first if missing or stale
+
+        trim_file may also be an index built by index_trim.
+    """
+    if is_index(trim_file):
+        return TrimIndex(trim_file)
+
+    index_file = index_path(trim_file)
+    if not os.path.exists(index_file) or \
+            os.path.getmtime(index_file) < os.path.getmtime(trim_file):
+        build_index(trim_file, index_file)
+    return TrimIndex(index_file)
+
+
+def index_trim(args):
+    """ Build a read accession index for a barcode or counter trim file.
+
+        The index is used by annotate --trim-index and is written next to the
+        trim file unless --output is given.
+    """
+    index_file = build_index(args.input, args.output)
+    print('wrote', index_file, file=sys.stderr)
@@ -1,9 +1,94 @@
-from collections import namedtuple
+from collections import Counter, defaultdict
 import vcf.filters
-import pysam
+import bamio
+import cigar
 
 
 PILEUP_DEPTH = 300000
+EA_TAG = 'ea'
+
+
+class AmpliconAlleleCounter(object):
+    """ Count the bases of each amplicon at positions visited in order.
+
+        The reads of a chromosome are fetched once and kept while they
+        overlap the current position, so nearby positions share the decoding
+        of their reads instead of each starting a pileup.  Visiting a
+        position before the previous one, or another chromosome, starts a
+        new walk.  As with a pileup, unmapped, secondary, QC failed and
+        duplicate reads are skipped and at most max_depth reads are counted
+        at a position.
+    """
+
+    def __init__(self, samfile, max_depth=PILEUP_DEPTH):
+        self.samfile = samfile
+        self.max_depth = max_depth
+        self.lengths = dict(zip(samfile.references, samfile.lengths))
+        self._chrom = None
+        self._pos = None
+        self._window = []
+
+    def _start(self, chrom, posn):
+        self._chrom = chrom
+        self._reads = self.samfile.fetch(chrom, posn, self.lengths[chrom])
+        self._next = next(self._reads, None)
+        self._window = []
+
+    def _add_reads(self, posn):
+        """ move the reads starting by posn from the BAM to the window """
+        window = [x for x in self._window if x[1] > posn]
+        while self._next is not None and self._next.pos <= posn:
+            read = self._next
+            self._next = next(self._reads, None)
+            if read.is_unmapped or read.is_secondary or read.is_qcfail or read.is_duplicate:
+                continue
+            end = read.aend
+            if end <= posn or not read.seq:
+                continue
+            try:
+                ea = read.opt(EA_TAG)
+            except KeyError:
+                ea = None
+            window.append((read.pos, end, read.cigar, read.seq, ea))
+        self._window = window
+
+    def counts(self, chrom, posn):
+        """ Return the counts of each base at 0-based posn, and a dictionary
+            of the base counts of each amplicon.
+        """
+        if chrom != self._chrom or posn < self._pos:
+            self._start(chrom, posn)
+        self._pos = posn
+        self._add_reads(posn)
+
+        bases = Counter()
+        by_amplicon = defaultdict(Counter)
+        for (pos, end, cig, seq, ea) in self._window[:self.max_depth]:
+            index = cigar.read_indexes(cig, pos, (posn,))[0]
+            if index is None:
+                continue
+            base = seq[index]
+            bases[base] += 1
+            if ea:
+                by_amplicon[ea][base] += 1
+        return bases, by_amplicon
+
+
+def allele_counts(samfile, sites, max_depth=PILEUP_DEPTH):
+    """ Return the counts of AmpliconAlleleCounter for many (chrom, 0-based
+        position) sites, keyed by site.  The sites are sorted so the reads of
+        each chromosome are only read once.
+    """
+    by_chrom = defaultdict(set)
+    for (chrom, posn) in sites:
+        by_chrom[chrom].add(posn)
+
+    counter = AmpliconAlleleCounter(samfile, max_depth)
+    found = {}
+    for (chrom, positions) in by_chrom.items():
+        for posn in sorted(positions):
+            found[(chrom, posn)] = counter.counts(chrom, posn)
+    return found
 
 
 class AmpliconFilter(vcf.filters.Base):
@@ -17,7 +102,8 @@ class AmpliconFilter(vcf.filters.Base):
                 help='Samfile')
 
     def __init__(self, args):
-        self.reads = pysam.Samfile(args.reads)
+        self.reads = bamio.open_bam(args.reads)
+        self.counter = AmpliconAlleleCounter(self.reads)
         self.threshold = 10
 
     def __call__(self, entry):
@@ -26,24 +112,11 @@ class AmpliconFilter(vcf.filters.Base):
         if entry.is_indel:
             raise NotImplementedError()
 
-        counts = {}
-        ab = {}
-        posn = entry.POS - 1
-        for puc in self.reads.pileup(entry.CHROM, posn-1, posn+1, max_depth=PILEUP_DEPTH):
-            if puc.pos != posn:
-                continue
-
-            for pu in puc.pileups:
-                if pu.is_del:
-                    continue
-                base = pu.alignment.query[pu.qpos]
-                ea = dict(pu.alignment.tags).get('ea', None)
-                ab[base] = ab.get(base, 0) + 1
-                if ea and base == entry.ALT[0]:
-                    counts[ea] = counts.get(ea, 0) + 1
+        # records of a sorted VCF are counted in one walk over the reads
+        bases, by_amplicon = self.counter.counts(entry.CHROM, entry.POS - 1)
         amps = 0
-        for amp, count in counts.items():
-            if count > self.threshold:
+        for counts in by_amplicon.values():
+            if counts[str(entry.ALT[0])] > self.threshold:
                 amps += 1
         if amps < 2:
             return True
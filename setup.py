@@ -11,7 +11,8 @@ setup(
         'pysam>=0.6',
         'pyvcf',
         'fastinterval',
-        'ngram'
+        'numpy',
+        'scipy',
     ],
     scripts=['amptools/amptools'],
     entry_points = {
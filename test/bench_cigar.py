@@ -0,0 +1,59 @@
+"""
+Time the cigar operations used when clipping reads.
+
+Run from the repository root with `python test/bench_cigar.py`.  The cigars
+are typical of mapped amplicon reads: mostly matches with a few indels and
+soft clips at either end.
+"""
+import random
+import timeit
+
+from amptools import cigar
+
+N = 20000
+
+
+def make_cigars(n, seed=1):
+    rand = random.Random(seed)
+    cigars = []
+    for _ in range(n):
+        cig = []
+        if rand.random() < 0.3:
+            cig.append((cigar.SOFT_CLIP, rand.randint(1, 20)))
+        cig.append((cigar.MATCH, rand.randint(20, 80)))
+        for _ in range(rand.randint(0, 3)):
+            cig.append((rand.choice([cigar.INS, cigar.DEL]), rand.randint(1, 3)))
+            cig.append((cigar.MATCH, rand.randint(10, 60)))
+        if rand.random() < 0.3:
+            cig.append((cigar.SOFT_CLIP, rand.randint(1, 20)))
+        cigars.append(cig)
+    return cigars
+
+
+def clip_cigar(cig):
+    """ the cigar work done by Amplicon.clip for a read trimmed at both ends """
+    n = cigar.read_length(cig)
+    seq = 'A' * n
+    cig, seq, qual = cigar.remove_soft(list(cig), seq, seq)
+    length = len(seq)
+    cig = cigar.trim_cigar(cig, length - 5, start=True)
+    cigar.ref_length(cig)
+    return cigar.trim_cigar(cig, length - 10)
+
+
+def main():
+    cigars = make_cigars(N)
+    tests = [
+        ('read_length', lambda: [cigar.read_length(c) for c in cigars]),
+        ('ref_length', lambda: [cigar.ref_length(c) for c in cigars]),
+        ('trim_cigar', lambda: [cigar.trim_cigar(list(c), cigar.read_length(c) - 5) for c in cigars]),
+        ('clip', lambda: [clip_cigar(c) for c in cigars]),
+    ]
+
+    for (name, func) in tests:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print '%-22s %6.2f us/read' % (name, 1e6 * best / N)
+
+
+if __name__ == '__main__':
+    main()
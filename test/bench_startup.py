@@ -0,0 +1,40 @@
+"""
+Time amptools start up, which dominates short jobs.
+
+Run from the repository root with `python test/bench_startup.py`.  Each
+command is started in a fresh interpreter, and the modules with slow imports
+that were loaded by importing the command line are listed.
+"""
+import subprocess
+import sys
+import timeit
+
+REPEAT = 10
+HEAVY = ['rpy2', 'pysam', 'numpy']
+
+COMMANDS = [
+    ('python', [sys.executable, '-c', 'pass']),
+    ('import amptools.main', [sys.executable, '-c', 'import amptools.main']),
+    ('amptools --help', [sys.executable, '-c',
+        'import sys; sys.argv = ["amptools", "--help"]; import amptools.main; amptools.main.parser.parse_args()']),
+]
+
+LOADED = 'import sys, amptools.main; print " ".join(m for m in %r if m in sys.modules)' % HEAVY
+
+
+def run(cmd):
+    with open('/dev/null', 'w') as null:
+        subprocess.call(cmd, stdout=null)
+
+
+def main():
+    for (name, cmd) in COMMANDS:
+        best = min(timeit.repeat(lambda: run(cmd), number=1, repeat=REPEAT))
+        print '%-22s %7.1f ms' % (name, 1e3 * best)
+
+    loaded = subprocess.check_output([sys.executable, '-c', LOADED]).split()
+    print 'heavy modules loaded by import: %s' % (' '.join(loaded) or 'none')
+
+
+if __name__ == '__main__':
+    main()
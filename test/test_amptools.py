@@ -1,14 +1,27 @@
 import os
+import sys
 import unittest
 import pysam
 import json
 import tempfile
 import commands
-from collections import Counter
+import StringIO
+from collections import Counter, defaultdict
 
 import make_test
 from amptools import annotate
+from amptools import amplicon
+from amptools import cigar
+from amptools import barcode
 from amptools import clip
+from amptools import coverage
+from amptools import duptable
+from amptools import main
+from amptools import metrics
+from amptools import parallel
+from amptools import stats
+from amptools import trimindex
+from amptools import util
 
 def path_to(testfile):
     op = os.path
@@ -73,6 +86,55 @@ class AnnotateTest(unittest.TestCase):
             assert dict(r.tags)[annotate.TAG_COUNT] in make_test.DBRS
 
 
+    def test_StreamingTrimFile(self):
+        expected = annotate._read_trim_file(path_to('trim2.txt'))
+        trim = annotate.StreamingTrimFile(path_to('trim2.txt'), lookahead=10)
+
+        # in order, out of order within the lookahead, then in order again
+        for qname in ['XXX0000', 'XXX0003', 'XXX0001', 'XXX0002', 'XXX0004']:
+            self.assertEquals(trim[qname], expected[qname])
+        self.assertEquals(trim.out_of_order, 2)
+
+        # records of the same read are found again
+        self.assertEquals(trim['XXX0003'], expected['XXX0003'])
+        self.assertEquals(trim.repeated, 1)
+
+        # a missing read does not lose the barcodes of the reads after it
+        self.assertRaises(KeyError, trim.__getitem__, 'missing')
+        self.assertRaises(KeyError, trim.__getitem__, 'missing2')
+        for qname in ['XXX0005', 'XXX0006', 'XXX0007']:
+            self.assertEquals(trim[qname], expected[qname])
+
+        # a read looked up before its line is beyond the lookahead
+        trim = annotate.StreamingTrimFile(path_to('trim2.txt'), lookahead=2)
+        self.assertRaises(KeyError, trim.__getitem__, 'XXX0003')
+        self.assertEquals(trim['XXX0000'], expected['XXX0000'])
+        self.assertEquals(trim['XXX0001'], expected['XXX0001'])
+        self.assertEquals(trim['XXX0002'], expected['XXX0002'])
+        self.assertRaises(Exception, trim.__getitem__, 'XXX0004')
+
+        # a BAM of every third read, in order, passes over the lines between
+        trim = annotate.StreamingTrimFile(path_to('trim2.txt'), lookahead=5)
+        qnames = sorted(expected)
+        for qname in qnames[::3]:
+            self.assertEquals(trim[qname], expected[qname])
+        self.assertEquals(len(trim._buffer) <= 5, True)
+        # and a read passed over is not found later
+        self.assertRaises(KeyError, trim.__getitem__, 'missing')
+        self.assertRaises(Exception, trim.__getitem__, qnames[1])
+
+    def test_TrimIndex(self):
+        expected = annotate._read_trim_file(path_to('trim2.txt'))
+        tmp = tempfile.mktemp()
+        try:
+            index = trimindex.TrimIndex(trimindex.build_index(path_to('trim2.txt'), tmp))
+            self.assertEquals(len(index), len(expected))
+            for qname, mc in expected.items():
+                self.assertEquals(index[qname], mc)
+            self.assertRaises(KeyError, index.__getitem__, 'missing')
+        finally:
+            os.unlink(tmp)
+
     def test_AmpliconAnnotator(self):
         sf = raw_bam()
         header = sf.header
@@ -168,9 +230,185 @@ class AnnotateTest(unittest.TestCase):
             #os.unlink(tmp)
             #os.unlink(tmpo)
 
+    def test_pipeline(self):
+        tmp = tempfile.mktemp()
+
+        print 'using tempfile', tmp
+        try:
+            os.system('amptools pipeline --output %s --rgs %s --bcs-read %s --counters %s --amps %s %s' % (
+                tmp, path_to('mids.txt'), path_to('trim.txt'), path_to('trim2.txt'),
+                path_to('amps.txt'), path_to(make_test.RAW_BAM)))
+
+            reads = list(pysam.Samfile(tmp))
+            assert all(r.opt(annotate.TAG_AMP) for r in reads)
+            non_dups = filter(lambda x: not x.is_duplicate, reads)
+            assert len(non_dups) == len(make_test.MIDS) * len(make_test.AMPS) * len(make_test.DBRS)
+
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+class MockRead(object):
+    def __init__(self, pos, aend, is_reverse=False):
+        self.pos, self.aend, self.is_reverse = pos, aend, is_reverse
+        self.is_unmapped = False
+
+
+class AmpliconIndexTest(unittest.TestCase):
+
+    def test_candidates(self):
+        st = stats.Stats('')
+        amps = [
+            amplicon.Amplicon(external_id=str(i), chr='chr1', start=s, end=s + 150,
+                strand=0, stats=st, offset_allowed=10)
+            for (i, s) in enumerate(range(10000, 0, -100))
+        ]
+        index = amplicon.AmpliconIndex(amps)
+
+        for read in [MockRead(505, 640), MockRead(495, 659, True), MockRead(50, 80)]:
+            expected = [a for a in amps if a.matches(read)]
+            found = [a for a in index.candidates(read) if a.matches(read)]
+            self.assertEquals(expected, found)
+
+        self.assertEquals(len(index.candidates(MockRead(505, 640))), 1)
+
+
+class MockTaggedRead(MockRead):
+    def __init__(self, qname, rname, pos, is_reverse, mapq, tags):
+        MockRead.__init__(self, pos, pos + 100, is_reverse)
+        self.qname, self.rname, self.mapq = qname, rname, mapq
+        self.tags = dict(tags)
+        self.is_duplicate = False
+
+    def opt(self, tag):
+        return self.tags[tag]
+
+
+class DuplicateMarkerTest(unittest.TestCase):
+
+    def make_reads(self):
+        import random
+        rand = random.Random(1)
+        reads = []
+        for rname in (0, 1):
+            for pos in sorted(rand.randrange(1000) for _ in range(300)):
+                tags = [('RG', rand.choice('AB')), (annotate.TAG_COUNT, rand.choice('XY'))]
+                reads.append(MockTaggedRead('r%d' % len(reads), rname, pos,
+                    rand.random() < 0.5, rand.randrange(60), tags[:rand.choice([1, 2, 2, 2])]))
+        return reads
+
+    def test_sorted(self):
+        expected = annotate.DuplicateMarker()
+        for r in self.make_reads():
+            expected.add(r)
+        expected = dict((r.qname, r.is_duplicate) for r in expected.finish())
+
+        marker = annotate.SortedDuplicateMarker()
+        found = []
+        reads = self.make_reads()
+        for r in reads:
+            found.extend(marker.add(r))
+            # reads are only held near the current position
+            self.assertTrue(len(marker.pending) < 100)
+        found.extend(marker.finish())
+
+        self.assertEquals([r.qname for r in found],
+            [r.qname for r in reads if r.qname in expected])
+        self.assertEquals(dict((r.qname, r.is_duplicate) for r in found), expected)
+
+    def test_umi_clustering(self):
+        reads = [MockTaggedRead('r%d' % i, 0, 100, False, i, [('RG', 'A'), (annotate.TAG_COUNT, mc)])
+            for (i, mc) in enumerate(['AAAA'] * 5 + ['AAAT', 'CCCC'])]
+        for (method, unique) in [(barcode.EXACT, 3), (barcode.DIRECTIONAL, 2)]:
+            marker = annotate.DuplicateMarker(method)
+            for r in reads:
+                r.is_duplicate = False
+                marker.add(r)
+            list(marker.finish())
+            self.assertEquals(marker.counts['unique'], unique)
+
+    def test_table(self):
+        for method in (barcode.EXACT, barcode.DIRECTIONAL):
+            expected = annotate.DuplicateMarker(method)
+            for r in self.make_reads():
+                expected.add(r)
+            expected = dict((r.qname, r.is_duplicate) for r in expected.finish())
+
+            table = duptable.DuplicateTable(annotate.DuplicateMarker.merge_distance, method)
+            reads = self.make_reads()
+            for r in reads:
+                table.add(r)
+            state = table.mark()
+
+            found = dict((r.qname, s == duptable.DUPLICATE)
+                for (r, s) in zip(reads, state) if s != duptable.DROP)
+            if method == barcode.EXACT:
+                self.assertEquals(found, expected)
+            # clustered groups may break mapping quality ties differently
+            self.assertEquals(sorted(found), sorted(expected))
+            self.assertEquals(sum(found.values()), sum(expected.values()))
+
+    def test_unsorted(self):
+        marker = annotate.SortedDuplicateMarker()
+        reads = self.make_reads()
+        marker.add(reads[10])
+        self.assertRaises(Exception, marker.add, reads[0])
+
+
+class BarcodeIndexTest(unittest.TestCase):
+
+    def test_hamming(self):
+        index = barcode.BarcodeIndex(['AAAA', 'CCCC', 'AAGG'], max_distance=1)
+        self.assertEquals(index.search('AAAT'), 'AAAA')
+        self.assertEquals(index.search('CCCC'), 'CCCC')
+        self.assertEquals(index.search('ACCA'), None)
+        # one mismatch from both AAAA and AAGG
+        self.assertEquals(index.search('AAGA'), None)
+        self.assertEquals(index.neighbours('AAGA'), [(1, 'AAAA'), (1, 'AAGG')])
+
+    def test_edit(self):
+        index = barcode.BarcodeIndex(['ACGTAC', 'TTTTTT'], max_distance=1, metric=barcode.EDIT)
+        self.assertEquals(index.search('ACGAC'), 'ACGTAC')
+        self.assertEquals(index.search('ACGTTAC'), 'ACGTAC')
+        self.assertEquals(index.search('TTTTTA'), 'TTTTTT')
+        self.assertEquals(index.search('GGGGGG'), None)
+
+    def test_LRUCache(self):
+        cache = barcode.LRUCache(2)
+        cache['A'] = 1
+        cache['B'] = None
+        self.assertEquals(cache['A'], 1)
+        cache['C'] = 3
+        # B was least recently used
+        self.assertRaises(KeyError, cache.__getitem__, 'B')
+        self.assertEquals(cache['C'], 3)
+        self.assertEquals((cache.hits, cache.misses, len(cache)), (2, 1, 2))
+
+    def test_cluster(self):
+        counts = {'AAAA': 100, 'AAAT': 3, 'AATT': 1, 'CCCC': 40, 'CCCG': 30}
+        found = barcode.cluster(counts, 1, barcode.DIRECTIONAL)
+        self.assertEquals(found, {'AAAA': 'AAAA', 'AAAT': 'AAAA', 'AATT': 'AAAA',
+            'CCCC': 'CCCC', 'CCCG': 'CCCG'})
+        found = barcode.cluster(counts, 1, barcode.HAMMING)
+        self.assertEquals(found['CCCG'], 'CCCC')
+        found = barcode.cluster(counts, 1, barcode.EXACT)
+        self.assertEquals(found['AAAT'], 'AAAT')
+
 
 class ClipTest(unittest.TestCase):
 
+    def test_aligned_indexes(self):
+        # 2S 3M 2D 3M 1I 2M at position 100 aligns bases to 100-102, 105-107, 108-109
+        cig = [(cigar.SOFT_CLIP, 2), (cigar.MATCH, 3), (cigar.DEL, 2), (cigar.MATCH, 3),
+            (cigar.INS, 1), (cigar.MATCH, 2)]
+        self.assertEquals(cigar.aligned_indexes(cig, 100, (100, 106)), [0, 4])
+        self.assertEquals(cigar.aligned_indexes(cig, 100, (103, 109)), [None, 7])
+        self.assertEquals(cigar.aligned_indexes(cig, 100, (99, 110)), [None, None])
+        # read indexes count the soft clip and insertion
+        self.assertEquals(cigar.read_indexes(cig, 100, (100, 106, 109)), [2, 6, 10])
+        self.assertEquals(cigar.read_indexes(cig, 100, (103, 110)), [None, None])
+
     def test_clip(self):
         tmp = tempfile.mktemp()
         tmpo = tempfile.mktemp()
@@ -220,6 +458,284 @@ NA3,None,B,4,40
 NA4,None,A,4,40
 NA4,None,B,4,40"""
 
+class MetricsTest(unittest.TestCase):
+    def test_metrics(self):
+        stream = StringIO.StringIO()
+        m = metrics.Metrics('test', progress=1e-9, stream=stream)
+        double = m.timer('double', lambda x: 2 * x)
+        reads = [double(x) for x in m.read_input(range(5000), total=10000)]
+        self.assertEquals(reads, range(0, 10000, 2))
+        self.assertEquals(list(m.iterate('more', 'ab')), ['a', 'b'])
+        m.advance(5000)
+
+        report = m.report()
+        self.assertEquals(report['reads'], 10000)
+        self.assertEquals([(k, v['calls']) for (k, v) in report['stages'].items()],
+                [('double', 5000), ('read', 5000), ('more', 2)])
+        lines = stream.getvalue().splitlines()
+        self.assertEquals(len(lines), 2)
+        assert lines[0].startswith('test: 4096 reads in 0:00:00'), lines[0]
+        assert lines[0].endswith('41.0% done, ETA 0:00:00'), lines[0]
+
+        # the stages and counts of a worker are added to those of the parent
+        m.counts['excluded'] += 2
+        worker = metrics.Metrics('worker')
+        worker.timer('double', lambda x: 2 * x)(1)
+        worker.counts['excluded'] += 1
+        m.merge(worker.take())
+        self.assertEquals(m.stages['double'][0], 5001)
+        self.assertEquals(m.counts['excluded'], 3)
+        self.assertEquals(worker.take(), ({}, {}))
+
+        # off by default
+        self.assertEquals(metrics.timer('double', len), len)
+        self.assertEquals(metrics.take(), None)
+
+class StartupTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        """ the command line should not import slow dependencies until a command runs """
+        loaded = commands.getoutput('%s -c \'import sys, amptools.main; print " ".join(m for m in ["rpy2", "pysam", "numpy"] if m in sys.modules)\'' % sys.executable)
+        assert loaded == '', loaded
+
+def _pileup_counts(samfile, chrom, posn):
+    """ the base counts of util.AmpliconAlleleCounter, from a pysam pileup """
+    bases, by_amplicon = Counter(), defaultdict(Counter)
+    # newer pysam leaves out bases below quality 13 by default
+    for column in samfile.pileup(chrom, posn, posn + 1, max_depth=util.PILEUP_DEPTH,
+            min_base_quality=0):
+        if column.pos != posn:
+            continue
+        for pu in column.pileups:
+            if pu.is_del:
+                continue
+            qpos = pu.qpos if hasattr(pu, 'qpos') else pu.query_position
+            base = pu.alignment.seq[qpos]
+            bases[base] += 1
+            tags = dict(pu.alignment.tags)
+            if util.EA_TAG in tags:
+                by_amplicon[tags[util.EA_TAG]][base] += 1
+    return bases, dict(by_amplicon)
+
+
+class MockVcfEntry(object):
+    def __init__(self, chrom, pos, alt):
+        self.CHROM, self.POS, self.ALT = chrom, pos, [alt]
+        self.ID = None
+        self.is_monomorphic = self.is_indel = False
+
+
+class AmpliconAlleleCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        header = dict(raw_bam().header)
+        header['SQ'] = list(header['SQ']) + [{'SN': 'chr2', 'LN': 10000}]
+
+        # copy the test reads under a header with a second reference
+        self.path = tempfile.mktemp(suffix='.bam')
+        copy = self.path + '.copy.bam'
+        out = pysam.Samfile(copy, 'wb', header=header)
+        for r in raw_bam():
+            out.write(r)
+        out.close()
+
+        # add soft clips, deletions, duplicates, a second reference and
+        # reads without an amplicon
+        reads = []
+        for (i, r) in enumerate(pysam.Samfile(copy)):
+            n = len(r.seq)
+            if i % 5 == 1:
+                r.cigar = [(cigar.SOFT_CLIP, 3), (cigar.MATCH, 50), (cigar.DEL, 2), (cigar.MATCH, n - 53)]
+            if i % 7 == 2:
+                r.is_duplicate = True
+            if i % 3:
+                r.tags = r.tags + [(util.EA_TAG, 'B' if r.is_reverse else 'A')]
+            if i % 4 == 3:
+                r.tid = 1
+            reads.append(r)
+        reads.sort(key=lambda r: (r.tid, r.pos))
+        os.unlink(copy)
+
+        out = pysam.Samfile(self.path, 'wb', header=header)
+        for r in reads:
+            out.write(r)
+        out.close()
+        pysam.index(self.path)
+        self.samfile = pysam.Samfile(self.path)
+
+        self.sites = [(chrom, posn) for chrom in ('chr1', 'chr2')
+            for posn in range(max(r.aend for r in reads) + 2)]
+        self.expected = dict((site, _pileup_counts(self.samfile, *site)) for site in self.sites)
+
+    def tearDown(self):
+        self.samfile.close()
+        for path in (self.path, self.path + '.bai'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_allele_counts(self):
+        # sites in any order are sorted into one walk per reference
+        found = util.allele_counts(self.samfile, reversed(self.sites))
+        for site in self.sites:
+            bases, by_amplicon = found[site]
+            self.assertEquals((bases, dict(by_amplicon)), self.expected[site], site)
+
+    def test_restart(self):
+        # going back or changing reference starts a new walk
+        counter = util.AmpliconAlleleCounter(self.samfile)
+        for site in [('chr1', 300), ('chr1', 150), ('chr2', 250), ('chr1', 250), ('chr1', 251)]:
+            bases, by_amplicon = counter.counts(*site)
+            self.assertEquals((bases, dict(by_amplicon)), self.expected[site], site)
+
+    def test_max_depth(self):
+        counter = util.AmpliconAlleleCounter(self.samfile, max_depth=5)
+        depths = [sum(counter.counts(*site)[0].values()) for site in self.sites]
+        self.assertEquals(max(depths), 5)
+
+    def test_AmpliconFilter(self):
+        args = MockArgs()
+        args.reads = self.path
+        ampcount = util.AmpliconFilter(args)
+
+        bases, by_amplicon = self.expected[('chr1', 300)]
+        ref = bases.most_common(1)[0][0]
+        # seen on both amplicons, then on none
+        self.assertEquals(ampcount(MockVcfEntry('chr1', 301, ref)), None)
+        other = [b for b in 'ACGT' if b not in bases][0]
+        self.assertEquals(ampcount(MockVcfEntry('chr1', 301, other)), True)
+
+
+def _records(path):
+    """ the reads of a BAM file, for comparing outputs """
+    return [(r.qname, r.flag, r.tid, r.pos, r.mapq, r.cigar, r.seq, sorted(r.tags))
+        for r in pysam.Samfile(path)]
+
+
+class ParallelTest(unittest.TestCase):
+    """ --workers gives the same output and report as a serial run """
+
+    COPIES = 8
+    # one copy of the test reads in each 16kb window of the BAM index
+    SHIFT = 1 << 14
+
+    def setUp(self):
+        # plan shards of a few reads from many small BGZF blocks
+        self.skim_reads = parallel.SKIM_READS
+        parallel.SKIM_READS = 50
+        self.tmp = tempfile.mkdtemp()
+
+        length = self.COPIES * self.SHIFT
+        header = dict(raw_bam().header)
+        header['SQ'] = [{'SN': 'chr1', 'LN': length}, {'SN': 'chr2', 'LN': length}]
+
+        # the test amplicons around each copy
+        amps = open(path_to('amps.txt')).read().splitlines()
+        self.amps = self.path('amps.txt')
+        with open(self.amps, 'w') as f:
+            print >>f, amps[0]
+            for k in range(self.COPIES):
+                for line in amps[1:]:
+                    eid, amp, trim = line.split('\t')
+                    shifted = [eid + str(k)]
+                    for coords in (amp, trim):
+                        chrom, span, strand = coords.split(':')
+                        start, end = [int(x) + k * self.SHIFT for x in span.split('-')]
+                        shifted.append('%s:%d-%d:%s' % (chrom, start, end, strand))
+                    print >>f, '\t'.join(shifted)
+        copy = self.path('copy.bam')
+        out = pysam.Samfile(copy, 'wb', header=header)
+        for r in raw_bam():
+            out.write(r)
+        out.close()
+
+        # sorted copies of the test reads with read groups and counters, on
+        # two references and without a reference
+        counters = annotate._read_trim_file(path_to('trim2.txt'))
+        reads = []
+        for k in range(self.COPIES):
+            for (i, r) in enumerate(pysam.Samfile(copy)):
+                r.pos += k * self.SHIFT
+                r.tags = r.tags + [('RG', 'NA%d' % (i % 4 + 1)), (annotate.TAG_COUNT, counters[r.qname])]
+                if i % 4 == 3:
+                    r.tid = 1
+                if i % 50 == 7:
+                    r.is_unmapped = True
+                    r.tid = r.pos = -1
+                reads.append(r)
+        reads.sort(key=lambda r: (r.tid < 0, r.tid, r.pos))
+
+        self.input = self.path('input.bam')
+        out = pysam.Samfile(self.input, 'wb0', header=header)
+        for r in reads:
+            out.write(r)
+        out.close()
+        self.total = len(reads)
+
+    def tearDown(self):
+        parallel.SKIM_READS = self.skim_reads
+        for name in os.listdir(self.tmp):
+            os.unlink(self.path(name))
+        os.rmdir(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def run_command(self, argv):
+        """ run an amptools command, returning what it printed """
+        args = main.parser.parse_args(argv)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO.StringIO()
+        try:
+            args.func(args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def assertSameAsSerial(self, argv, name):
+        serial, sharded = self.path(name + '1.bam'), self.path(name + '3.bam')
+        report = self.run_command(argv[:1] + ['--output', serial] + argv[1:])
+        self.assertEquals(self.run_command(argv[:1] + ['--workers', '3', '--output', sharded] + argv[1:]),
+            report)
+        self.assertEquals(pysam.Samfile(sharded).header, pysam.Samfile(serial).header)
+        self.assertEquals(_records(sharded), _records(serial))
+        return report
+
+    def test_plan_shards(self):
+        inp = pysam.Samfile(self.input)
+        first = inp.tell()
+        expected = [(r.qname, r.pos) for r in inp]
+
+        for indexed in (False, True):
+            if indexed:
+                pysam.index(self.input)
+            inp.seek(first)
+            shards = parallel.plan_shards(inp, self.input, 8)
+            self.assertEquals(inp.tell(), first)
+            assert len(shards) > 4, shards
+            self.assertEquals(shards[0][0], first)
+            self.assertEquals(shards[-1][1], None)
+            self.assertEquals([end for (_, end) in shards[:-1]], [start for (start, _) in shards[1:]])
+            found = [(r.qname, r.pos) for (start, end) in shards for r in parallel.iter_shard(inp, start, end)]
+            self.assertEquals(found, expected)
+
+    def test_annotate(self):
+        argv = ['annotate', '--amps', self.amps, '--exclude-offtarget', self.input]
+        report = self.assertSameAsSerial(argv, 'unindexed')
+        assert 'processed %d reads' % self.total in report, report
+        pysam.index(self.input)
+        self.assertSameAsSerial(argv, 'indexed')
+
+    def test_clip(self):
+        annotated = self.path('annotated.bam')
+        self.run_command(['annotate', '--amps', self.amps, '--compression-level', '0',
+            '--output', annotated, self.input])
+        self.assertSameAsSerial(['clip', annotated], 'clip')
+
+    def test_duplicates(self):
+        pysam.index(self.input)
+        report = self.assertSameAsSerial(['duplicates', '--sorted', self.input], 'duplicates')
+        assert 'duplicates: %d reads' % self.total in report, report
+
+
 class StatsTest(unittest.TestCase):
     def test_stats(self):
         tmp1, tmp2 =  tempfile.mktemp(),  tempfile.mktemp()
@@ -238,5 +754,73 @@ class StatsTest(unittest.TestCase):
         statsout = statsout.replace('\r', '')
         assert statsout == expected_stats
 
-
-
+    def test_CoverageMatrix(self):
+        matrix = coverage.CoverageMatrix(['B1', 'A1'], ['Y', 'X'])
+        matrix.BATCH = 2
+        for (rg, amp, dup) in [('A1', 'X', False), ('A1', 'X', True), ('B1', 'Y', False),
+                ('C1', 'X', False), ('A1', 'Z', False)]:
+            matrix.add(rg, amp, dup)
+        matrix.add_counts({('B1', 'X'): 3}, {('B1', 'X'): 1})
+        matrix.flush()
+
+        self.assertEquals((matrix.rgs, matrix.amps), (['A1', 'B1'], ['X', 'Y']))
+        self.assertEquals(matrix.reads.tolist(), [[2, 0], [3, 1]])
+        self.assertEquals(matrix.uniq.tolist(), [[1, 0], [1, 1]])
+        self.assertEquals(matrix.rg_reads('B1'), 4)
+
+    def test_DepthProfile(self):
+        st = stats.Stats('')
+        amps = [amplicon.Amplicon(external_id='X', chr='chr1', start=90, end=130, trim_start=100,
+                    trim_end=120, stats=st),
+                amplicon.Amplicon(external_id='Y', chr='chr1', start=190, end=230, trim_start=200,
+                    trim_end=205, stats=st)]
+        depth = coverage.DepthProfile(amps)
+        depth.BATCH = 2
+        for (amp, pos, aend, dup) in [('X', 90, 110, False), ('X', 105, 130, True),
+                ('Y', 202, 203, False), ('Z', 100, 110, False)]:
+            r = MockRead(pos, aend)
+            r.is_duplicate = dup
+            depth.add(amp, r)
+
+        all_reads, unique = depth.depths()
+        self.assertEquals(all_reads.tolist(), [1] * 5 + [2] * 5 + [1] * 10 + [0, 0, 1, 0, 0])
+        self.assertEquals(unique.tolist(), [1] * 10 + [0] * 10 + [0, 0, 1, 0, 0])
+        mean, minimum, uniformity = depth.summary(unique)
+        self.assertEquals(mean.tolist(), [0.5, 0.2])
+        self.assertEquals(minimum.tolist(), [0, 0])
+        self.assertEquals(uniformity.tolist(), [0.5, 0.2])
+
+
+
+
+    def test_ll_test(self):
+        # log(dbinom) sums as in the R version, computed by hand
+        test_val, ab = stats.ll_test([10, 0], [0, 10], [0, 2])
+        self.assertAlmostEquals(test_val, -13.458889464848516)
+        self.assertEquals(ab, 0.5)
+        test_vals, abs_ = stats.ll_tests([[10, 0, 5], [12, 8, 0]], [[0, 10, 5], [0, 0, 3]],
+                [[0, 2, 1], [0, 0, 2]], called=[[True, True, False], [True, True, True]])
+        self.assertAlmostEquals(test_vals[0], test_val)
+        self.assertAlmostEquals(test_vals[1], stats.ll_test([12, 8, 0], [0, 0, 3], [0, 0, 2])[0])
+        self.assertEquals(stats.amp_bias_test([3, 50, 99], [100, 100, 100]).tolist(), [0, 1, 2])
+
+    def test_neg_binom_fit(self):
+        fit = stats.neg_binom_fit([5, 1, 0, 7, 30, 2, 2, 9])
+        self.assertAlmostEquals(fit.size, 0.763457523, places=6)
+        self.assertEquals(fit.mu, 7)
+        self.assertEquals([round(q, 6) for q in fit.quantiles], [0, 0.07, 0.35, 0.7, 1.75, 3.5])
+        sizes, mus, quantiles = stats.neg_binom_fits([[5, 1, 0, 7, 30, 2, 2, 9], [4] * 8])
+        self.assertAlmostEquals(sizes[0], fit.size)
+        self.assertEquals(sizes[1], float('inf'))
+        self.assertEquals(mus.tolist(), [7, 4])
+
+    def test_cluster_separation(self):
+        calls = [{'RO': 20, 'AO': 0, 'GT': (0, 0)}, {'RO': 18, 'AO': 2, 'GT': (0, 0)},
+                {'RO': 10, 'AO': 10, 'GT': (0, 1)}, {'RO': 0, 'AO': 0, 'GT': (1, 1)}]
+        # centres 0.95 and 0.5, mean distances 0.05 and 0
+        self.assertAlmostEquals(stats.cluster_separation(calls), 0.05 / 0.45)
+        self.assertEquals(stats.cluster_separation(calls[:2]), 0)
+        scores = stats.cluster_separations([[20, 18, 10, 0], [10, 0, 10, 0]],
+                [[0, 2, 10, 0], [10, 0, 10, 0]], [[0, 0, 1, 2], [0, 0, 1, 2]])
+        self.assertAlmostEquals(scores[0], 0.05 / 0.45)
+        self.assertEquals(scores[1], float('inf'))